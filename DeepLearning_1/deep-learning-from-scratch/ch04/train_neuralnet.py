@@ -29,6 +29,7 @@ for i in range(iters_num):
     
     # 勾配の計算
     #grad = network.numerical_gradient(x_batch, t_batch)
+    #grad = network.numerical_gradient(x_batch, t_batch, batch_size=64)  # まとめて損失を求める
     grad = network.gradient(x_batch, t_batch)
     
     # パラメータの更新
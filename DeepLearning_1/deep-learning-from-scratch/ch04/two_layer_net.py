@@ -2,7 +2,7 @@
 import sys, os
 sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
 from common.functions import *
-from common.gradient import numerical_gradient
+from common.gradient import numerical_gradient, numerical_gradient_batch
 import numpy as np
 
 
@@ -41,15 +41,41 @@ class TwoLayerNet:
         accuracy = np.sum(y == t) / float(x.shape[0])
         return accuracy
         
+    def stacked_loss(self, x, t, stacked):
+        """一部のパラメータをk組重ねたものに置き換えて、k個の損失をまとめて求める
+
+        stacked : パラメータ名と、先頭の軸にk組重ねた値のディクショナリ（e.g. {'W1': (k, 784, 50)の配列}）
+        """
+        params = dict(self.params, **stacked)
+        W1, W2 = params['W1'], params['W2']
+        b1, b2 = params['b1'], params['b2']
+
+        # 重ねた軸はnp.matmulのブロードキャストでそのまま扱う
+        a1 = np.matmul(x, W1) + b1[..., np.newaxis, :]
+        z1 = sigmoid(a1)
+        a2 = np.matmul(z1, W2) + b2[..., np.newaxis, :]
+        y = softmax(a2)
+
+        if t.ndim != 1 : t = np.argmax(t, axis=1)
+        batch_size = x.shape[0]
+        return -np.sum(np.log(y[..., np.arange(batch_size), t] + 1e-7), axis=-1) / batch_size
+
     # x:入力データ, t:教師データ
-    def numerical_gradient(self, x, t):
+    def numerical_gradient(self, x, t, batch_size=None, processes=None):
+        """数値微分で勾配を求める
+
+        batch_sizeを指定すると、ずらしたパラメータをbatch_size組ずつ重ねてまとめて損失を求める。
+        processesを指定すると、パラメータの要素を分けて複数のプロセスで求める
+        """
         loss_W = lambda W: self.loss(x, t)
         
         grads = {}
-        grads['W1'] = numerical_gradient(loss_W, self.params['W1'])
-        grads['b1'] = numerical_gradient(loss_W, self.params['b1'])
-        grads['W2'] = numerical_gradient(loss_W, self.params['W2'])
-        grads['b2'] = numerical_gradient(loss_W, self.params['b2'])
+        for key in ('W1', 'b1', 'W2', 'b2'):
+            if batch_size is not None:
+                grads[key] = numerical_gradient_batch(lambda W: self.stacked_loss(x, t, {key: W}),
+                                                      self.params[key], batch_size)
+            else:
+                grads[key] = numerical_gradient(loss_W, self.params[key], processes)
         
         return grads
         
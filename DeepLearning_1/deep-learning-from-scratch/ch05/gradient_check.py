@@ -3,6 +3,7 @@ import sys, os
 sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
 import numpy as np
 from dataset.mnist import load_mnist
+from common.gradient import gradient_check
 from two_layer_net import TwoLayerNet
 
 # データの読み込み
@@ -13,9 +14,11 @@ network = TwoLayerNet(input_size=784, hidden_size=50, output_size=10)
 x_batch = x_train[:3]
 t_batch = t_train[:3]
 
-grad_numerical = network.numerical_gradient(x_batch, t_batch)
 grad_backprop = network.gradient(x_batch, t_batch)
 
-for key in grad_numerical.keys():
-    diff = np.average( np.abs(grad_backprop[key] - grad_numerical[key]) )
-    print(key + ":" + str(diff))
\ No newline at end of file
+# パラメータごとにランダムに選んだ要素だけ数値微分と比べる（すべて調べる場合はnum_samples=None）
+loss_W = lambda W: network.loss(x_batch, t_batch)
+errors = gradient_check(loss_W, network.params, grad_backprop, num_samples=20, num_directions=1)
+
+for key, error in errors.items():
+    print(key + ":" + str(error))
@@ -35,7 +35,7 @@ for i in range(iters_num):
     for key in ('W1', 'b1', 'W2', 'b2'):
         network.params[key] -= learning_rate * grad[key]
     
-    loss = network.loss(x_batch, t_batch)
+    loss = network.last_loss  # gradientで計算済みの損失
     train_loss_list.append(loss)
     
     if i % iter_per_epoch == 0:
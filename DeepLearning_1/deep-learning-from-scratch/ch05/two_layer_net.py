@@ -17,10 +17,10 @@ class TwoLayerNet:
         self.params['W2'] = weight_init_std * np.random.randn(hidden_size, output_size) 
         self.params['b2'] = np.zeros(output_size)
 
-        # レイヤの生成
+        # レイヤの生成（ReLUは直前の層の出力を上書きする）
         self.layers = OrderedDict()
         self.layers['Affine1'] = Affine(self.params['W1'], self.params['b1'])
-        self.layers['Relu1'] = Relu()
+        self.layers['Relu1'] = Relu(inplace=True)
         self.layers['Affine2'] = Affine(self.params['W2'], self.params['b2'])
 
         self.lastLayer = SoftmaxWithLoss()
@@ -37,7 +37,8 @@ class TwoLayerNet:
         return self.lastLayer.forward(y, t)
     
     def accuracy(self, x, t):
-        y = self.predict(x)
+        with no_grad():
+            y = self.predict(x)
         y = np.argmax(y, axis=1)
         if t.ndim != 1 : t = np.argmax(t, axis=1)
         
@@ -57,8 +58,8 @@ class TwoLayerNet:
         return grads
         
     def gradient(self, x, t):
-        # forward
-        self.loss(x, t)
+        # forward（損失はlast_lossに保持し、もう一度forwardしなくて済むようにする）
+        self.last_loss = self.loss(x, t)
 
         # backward
         dout = 1
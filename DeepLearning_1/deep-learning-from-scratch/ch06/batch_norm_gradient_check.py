@@ -4,6 +4,7 @@ sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポ
 import numpy as np
 from dataset.mnist import load_mnist
 from common.multi_layer_net_extend import MultiLayerNetExtend
+from common.gradient import gradient_check
 
 # データの読み込み
 (x_train, t_train), (x_test, t_test) = load_mnist(normalize=True, one_hot_label=True)
@@ -15,9 +16,10 @@ x_batch = x_train[:1]
 t_batch = t_train[:1]
 
 grad_backprop = network.gradient(x_batch, t_batch)
-grad_numerical = network.numerical_gradient(x_batch, t_batch)
 
+# パラメータごとにランダムに選んだ要素だけ数値微分と比べる（すべて調べる場合はnum_samples=None）
+loss_W = lambda W: network.loss(x_batch, t_batch, train_flg=True)
+errors = gradient_check(loss_W, network.params, grad_backprop, num_samples=20, num_directions=1)
 
-for key in grad_numerical.keys():
-    diff = np.average( np.abs(grad_backprop[key] - grad_numerical[key]) )
-    print(key + ":" + str(diff))
\ No newline at end of file
+for key in errors.keys():
+    print(key + ":" + str(errors[key]))
@@ -0,0 +1,98 @@
+# coding: utf-8
+import os
+import sys
+sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
+import time
+import tracemalloc
+import numpy as np
+from dataset.mnist import load_mnist
+from common.multi_layer_net import MultiLayerNet
+from common.optimizer import *
+
+
+# 式をそのまま書いた更新（パラメータごとに一時配列を作る）==========
+class ReferenceSGD(SGD):
+    def update(self, params, grads):
+        for key in params.keys():
+            params[key] -= self.lr * grads[key]
+
+
+class ReferenceMomentum(Momentum):
+    def update(self, params, grads):
+        if self.v is None:
+            self.v = {key: np.zeros_like(val) for key, val in params.items()}
+        for key in params.keys():
+            self.v[key] = self.momentum*self.v[key] - self.lr*grads[key]
+            params[key] += self.v[key]
+
+
+class ReferenceAdaGrad(AdaGrad):
+    def update(self, params, grads):
+        if self.h is None:
+            self.h = {key: np.zeros_like(val) for key, val in params.items()}
+        for key in params.keys():
+            self.h[key] += grads[key] * grads[key]
+            params[key] -= self.lr * grads[key] / (np.sqrt(self.h[key]) + 1e-7)
+
+
+class ReferenceAdam(Adam):
+    def update(self, params, grads):
+        if self.m is None:
+            self.m = {key: np.zeros_like(val) for key, val in params.items()}
+            self.v = {key: np.zeros_like(val) for key, val in params.items()}
+        self.iter += 1
+        lr_t = self.lr * (1.0 - self.beta2**self.iter)**0.5 / (1.0 - self.beta1**self.iter)
+        for key in params.keys():
+            self.m[key] += (1 - self.beta1) * (grads[key] - self.m[key])
+            self.v[key] += (1 - self.beta2) * (grads[key]**2 - self.v[key])
+            params[key] -= lr_t * self.m[key] / (np.sqrt(self.v[key]) + 1e-7)
+
+
+# 0:MNISTデータの読み込み（optimizer_compare_mnist.pyと同じ設定）==========
+(x_train, t_train), (x_test, t_test) = load_mnist(normalize=True)
+
+batch_size = 128
+max_iterations = 500
+
+network = MultiLayerNet(input_size=784, hidden_size_list=[100, 100, 100, 100], output_size=10)
+batch_mask = np.random.choice(x_train.shape[0], batch_size)
+grads = network.gradient(x_train[batch_mask], t_train[batch_mask])
+
+
+def benchmark(optimizer, flat):
+    """更新だけにかかる時間と、1回の更新で一時的に確保したメモリを測る"""
+    params = {key: val.copy() for key, val in network.params.items()}
+    if flat:  # ネットワークのflat_params、flat_gradsと同じく1つのバッファにまとめる
+        params = {'flat': np.concatenate([val.ravel() for val in params.values()])}
+        g = {'flat': np.concatenate([val.ravel() for val in grads.values()])}
+    else:
+        g = grads
+    optimizer.update(params, g)  # 状態の初期化を除く
+
+    tracemalloc.start()
+    optimizer.update(params, g)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(max_iterations):
+        optimizer.update(params, g)
+    elapsed = time.perf_counter() - start
+    return elapsed / max_iterations * 1e6, peak
+
+
+# 1:実験の設定==========
+optimizers = {}
+optimizers['SGD'] = (ReferenceSGD, SGD)
+optimizers['Momentum'] = (ReferenceMomentum, Momentum)
+optimizers['AdaGrad'] = (ReferenceAdaGrad, AdaGrad)
+optimizers['Adam'] = (ReferenceAdam, Adam)
+
+print("{:<9} {:>14} {:>14} {:>14} {:>14}".format(
+    "optimizer", "reference[us]", "in-place[us]", "flat[us]", "alloc[KB]"))
+for key, (reference, inplace) in optimizers.items():
+    t_ref, m_ref = benchmark(reference(), flat=False)
+    t_inplace, m_inplace = benchmark(inplace(), flat=False)
+    t_flat, m_flat = benchmark(inplace(), flat=True)
+    print("{:<9} {:>14.1f} {:>14.1f} {:>14.1f} {:>5.0f} -> {:>5.0f}".format(
+        key, t_ref, t_inplace, t_flat, m_ref / 1024, max(m_inplace, m_flat) / 1024))
@@ -20,9 +20,8 @@ t_train = t_train[:300]
 weight_decay_lambda = 0.1
 # ====================================================
 
-network = MultiLayerNet(input_size=784, hidden_size_list=[100, 100, 100, 100, 100, 100], output_size=10,
-                        weight_decay_lambda=weight_decay_lambda)
-optimizer = SGD(lr=0.01)
+network = MultiLayerNet(input_size=784, hidden_size_list=[100, 100, 100, 100, 100, 100], output_size=10)
+optimizer = SGD(lr=0.01, weight_decay=weight_decay_lambda)  # 重みの更新時に減衰させる
 
 max_epochs = 201
 train_size = x_train.shape[0]
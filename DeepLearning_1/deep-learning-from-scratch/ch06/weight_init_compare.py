@@ -41,13 +41,13 @@ for i in range(max_iterations):
         grads = networks[key].gradient(x_batch, t_batch)
         optimizer.update(networks[key].params, grads)
     
-        loss = networks[key].loss(x_batch, t_batch)
+        loss = networks[key].last_loss  # gradientで計算済みの損失
         train_loss[key].append(loss)
     
     if i % 100 == 0:
         print("===========" + "iteration:" + str(i) + "===========")
         for key in weight_init_types.keys():
-            loss = networks[key].loss(x_batch, t_batch)
+            loss = train_loss[key][-1]
             print(key + ":" + str(loss))
 
 
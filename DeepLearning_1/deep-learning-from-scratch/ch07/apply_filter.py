@@ -44,7 +44,7 @@ for i in range(16):
 
     w = w.reshape(1, *w.shape)
     #b = b.reshape(1, *b.shape)
-    conv_layer = Convolution(w, b) 
+    conv_layer = Convolution(w, b, algo='fft')  # 画像が大きいのでFFTで畳み込む
     out = conv_layer.forward(img)
     out = out.reshape(out.shape[2], out.shape[3])
     
@@ -1,6 +1,9 @@
 # coding: utf-8
+import sys, os
+sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
 import numpy as np
 from simple_convnet import SimpleConvNet
+from common.gradient import gradient_check
 
 network = SimpleConvNet(input_dim=(1,10, 10), 
                         conv_param = {'filter_num':10, 'filter_size':3, 'pad':0, 'stride':1},
@@ -9,8 +12,11 @@ network = SimpleConvNet(input_dim=(1,10, 10),
 X = np.random.rand(100).reshape((1, 1, 10, 10))
 T = np.array([1]).reshape((1,1))
 
-grad_num = network.numerical_gradient(X, T)
 grad = network.gradient(X, T)
 
-for key, val in grad_num.items():
-    print(key, np.abs(grad_num[key] - grad[key]).mean())
\ No newline at end of file
+# パラメータごとにランダムに選んだ要素だけ数値微分と比べる（すべて調べる場合はnum_samples=None）
+loss_w = lambda w: network.loss(X, T)
+errors = gradient_check(loss_w, network.params, grad, num_samples=20, num_directions=1)
+
+for key, error in errors.items():
+    print(key, error)
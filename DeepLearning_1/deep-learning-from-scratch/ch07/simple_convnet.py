@@ -5,6 +5,7 @@ import pickle
 import numpy as np
 from collections import OrderedDict
 from common.layers import *
+from common.util import flatten_params, flat_views
 from common.gradient import numerical_gradient
 
 
@@ -22,10 +23,14 @@ class SimpleConvNet:
     weight_init_std : 重みの標準偏差を指定（e.g. 0.01）
         'relu'または'he'を指定した場合は「Heの初期値」を設定
         'sigmoid'または'xavier'を指定した場合は「Xavierの初期値」を設定
+    use_batchnorm : Trueの場合はconvとaffineの直後（reluの前）にBatch Normalizationを入れる
+        （convの後はチャンネルごとのSpatialBatchNormalization）
+    dtype : パラメータのデータ型（e.g. np.float32）
     """
     def __init__(self, input_dim=(1, 28, 28), 
                  conv_param={'filter_num':30, 'filter_size':5, 'pad':0, 'stride':1},
-                 hidden_size=100, output_size=10, weight_init_std=0.01):
+                 hidden_size=100, output_size=10, weight_init_std=0.01, use_batchnorm=False,
+                 dtype=np.float64):
         filter_num = conv_param['filter_num']
         filter_size = conv_param['filter_size']
         filter_pad = conv_param['pad']
@@ -35,32 +40,60 @@ class SimpleConvNet:
         pool_output_size = int(filter_num * (conv_output_size/2) * (conv_output_size/2))
 
         # 重みの初期化
+        self.dtype = dtype
+        self.use_batchnorm = use_batchnorm
         self.params = {}
-        self.params['W1'] = weight_init_std * \
-                            np.random.randn(filter_num, input_dim[0], filter_size, filter_size)
-        self.params['b1'] = np.zeros(filter_num)
-        self.params['W2'] = weight_init_std * \
-                            np.random.randn(pool_output_size, hidden_size)
-        self.params['b2'] = np.zeros(hidden_size)
-        self.params['W3'] = weight_init_std * \
-                            np.random.randn(hidden_size, output_size)
-        self.params['b3'] = np.zeros(output_size)
-
-        # レイヤの生成
+        self.params['W1'] = (weight_init_std * \
+                             np.random.randn(filter_num, input_dim[0], filter_size, filter_size)).astype(dtype)
+        self.params['b1'] = np.zeros(filter_num, dtype=dtype)
+        self.params['W2'] = (weight_init_std * \
+                             np.random.randn(pool_output_size, hidden_size)).astype(dtype)
+        self.params['b2'] = np.zeros(hidden_size, dtype=dtype)
+        self.params['W3'] = (weight_init_std * \
+                             np.random.randn(hidden_size, output_size)).astype(dtype)
+        self.params['b3'] = np.zeros(output_size, dtype=dtype)
+        if use_batchnorm:
+            self.params['gamma1'] = np.ones(filter_num, dtype=dtype)
+            self.params['beta1'] = np.zeros(filter_num, dtype=dtype)
+            self.params['gamma2'] = np.ones(hidden_size, dtype=dtype)
+            self.params['beta2'] = np.zeros(hidden_size, dtype=dtype)
+
+        # パラメータと勾配はそれぞれ1つの連続したバッファのビューにする
+        # （オプティマイザはflat_params、flat_gradsをまとめて更新できる）
+        self.flat_params = flatten_params(self.params)
+        self.flat_grads = np.zeros_like(self.flat_params)
+        self.grads = flat_views(self.flat_grads, self.params)
+
+        # レイヤの生成（ReLUは直前の層の出力を上書きする）
         self.layers = OrderedDict()
         self.layers['Conv1'] = Convolution(self.params['W1'], self.params['b1'],
                                            conv_param['stride'], conv_param['pad'])
-        self.layers['Relu1'] = Relu()
+        if use_batchnorm:
+            self.layers['BatchNorm1'] = SpatialBatchNormalization(self.params['gamma1'], self.params['beta1'])
+        self.layers['Relu1'] = Relu(inplace=True)
         self.layers['Pool1'] = Pooling(pool_h=2, pool_w=2, stride=2)
         self.layers['Affine1'] = Affine(self.params['W2'], self.params['b2'])
-        self.layers['Relu2'] = Relu()
+        if use_batchnorm:
+            self.layers['BatchNorm2'] = BatchNormalization(self.params['gamma2'], self.params['beta2'])
+        self.layers['Relu2'] = Relu(inplace=True)
         self.layers['Affine2'] = Affine(self.params['W3'], self.params['b3'])
+        self.layers = fuse_relu(self.layers)
+        for i, key in enumerate(['Conv1', 'Affine1', 'Affine2']):
+            self.layers[key].dW = self.grads['W' + str(i+1)]
+            self.layers[key].db = self.grads['b' + str(i+1)]
+        if use_batchnorm:
+            for idx in (1, 2):
+                self.layers['BatchNorm' + str(idx)].dgamma = self.grads['gamma' + str(idx)]
+                self.layers['BatchNorm' + str(idx)].dbeta = self.grads['beta' + str(idx)]
 
         self.last_layer = SoftmaxWithLoss()
 
-    def predict(self, x):
-        for layer in self.layers.values():
-            x = layer.forward(x)
+    def predict(self, x, train_flg=False):
+        for key, layer in self.layers.items():
+            if "BatchNorm" in key:
+                x = layer.forward(x, train_flg)
+            else:
+                x = layer.forward(x)
 
         return x
 
@@ -68,7 +101,7 @@ class SimpleConvNet:
         """損失関数を求める
         引数のxは入力データ、tは教師ラベル
         """
-        y = self.predict(x)
+        y = self.predict(x, train_flg=True)
         return self.last_layer.forward(y, t)
 
     def accuracy(self, x, t, batch_size=100):
@@ -79,7 +112,8 @@ class SimpleConvNet:
         for i in range(int(x.shape[0] / batch_size)):
             tx = x[i*batch_size:(i+1)*batch_size]
             tt = t[i*batch_size:(i+1)*batch_size]
-            y = self.predict(tx)
+            with no_grad():
+                y = self.predict(tx)
             y = np.argmax(y, axis=1)
             acc += np.sum(y == tt) 
         
@@ -105,6 +139,9 @@ class SimpleConvNet:
         for idx in (1, 2, 3):
             grads['W' + str(idx)] = numerical_gradient(loss_w, self.params['W' + str(idx)])
             grads['b' + str(idx)] = numerical_gradient(loss_w, self.params['b' + str(idx)])
+            if self.use_batchnorm and idx != 3:
+                grads['gamma' + str(idx)] = numerical_gradient(loss_w, self.params['gamma' + str(idx)])
+                grads['beta' + str(idx)] = numerical_gradient(loss_w, self.params['beta' + str(idx)])
 
         return grads
 
@@ -122,8 +159,8 @@ class SimpleConvNet:
             grads['W1']、grads['W2']、...は各層の重み
             grads['b1']、grads['b2']、...は各層のバイアス
         """
-        # forward
-        self.loss(x, t)
+        # forward（損失はlast_lossに保持し、もう一度forwardしなくて済むようにする）
+        self.last_loss = self.loss(x, t)
 
         # backward
         dout = 1
@@ -139,6 +176,10 @@ class SimpleConvNet:
         grads['W1'], grads['b1'] = self.layers['Conv1'].dW, self.layers['Conv1'].db
         grads['W2'], grads['b2'] = self.layers['Affine1'].dW, self.layers['Affine1'].db
         grads['W3'], grads['b3'] = self.layers['Affine2'].dW, self.layers['Affine2'].db
+        if self.use_batchnorm:
+            for idx in (1, 2):
+                grads['gamma' + str(idx)] = self.layers['BatchNorm' + str(idx)].dgamma
+                grads['beta' + str(idx)] = self.layers['BatchNorm' + str(idx)].dbeta
 
         return grads
         
@@ -146,6 +187,11 @@ class SimpleConvNet:
         params = {}
         for key, val in self.params.items():
             params[key] = val
+        # 推論時に使う移動平均も一緒に保存する
+        if self.use_batchnorm:
+            for idx in (1, 2):
+                params['running_mean' + str(idx)] = self.layers['BatchNorm' + str(idx)].running_mean
+                params['running_var' + str(idx)] = self.layers['BatchNorm' + str(idx)].running_var
         with open(file_name, 'wb') as f:
             pickle.dump(params, f)
 
@@ -153,8 +199,9 @@ class SimpleConvNet:
         with open(file_name, 'rb') as f:
             params = pickle.load(f)
         for key, val in params.items():
-            self.params[key] = val
-
-        for i, key in enumerate(['Conv1', 'Affine1', 'Affine2']):
-            self.layers[key].W = self.params['W' + str(i+1)]
-            self.layers[key].b = self.params['b' + str(i+1)]
\ No newline at end of file
+            if key in self.params:
+                self.params[key][...] = val  # レイヤが参照するビューにそのまま書き込む
+        if self.use_batchnorm and 'running_mean1' in params:
+            for idx in (1, 2):
+                self.layers['BatchNorm' + str(idx)].running_mean = params['running_mean' + str(idx)].astype(self.dtype)
+                self.layers['BatchNorm' + str(idx)].running_var = params['running_var' + str(idx)].astype(self.dtype)
\ No newline at end of file
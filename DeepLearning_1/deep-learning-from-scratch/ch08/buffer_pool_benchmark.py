@@ -0,0 +1,48 @@
+# coding: utf-8
+import sys, os
+sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
+import time
+import tracemalloc
+import numpy as np
+from deep_convnet import DeepConvNet
+from dataset.mnist import load_mnist
+from common.optimizer import Adam
+from common.buffer_pool import BufferPool, using_buffer_pool
+
+(x_train, t_train), (x_test, t_test) = load_mnist(flatten=False)
+
+max_iterations = 50
+batch_size = 100
+
+
+def train(pool):
+    """1ステップあたりに実際に確保したメモリ（tracemallocのピーク）も表示する
+
+    ステップの最初の時点から増えた分のピークなので、プールの配列を使い回している
+    ステップでは、プール以外で確保される小さな配列などの分だけになる
+    """
+    np.random.seed(0)  # 重みの初期値とミニバッチを揃える
+    network = DeepConvNet()
+    optimizer = Adam(lr=0.001)
+
+    start = time.perf_counter()
+    tracemalloc.start()
+    for i in range(max_iterations):
+        batch_mask = np.random.choice(x_train.shape[0], batch_size)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        with using_buffer_pool(pool):
+            grads = network.gradient(x_train[batch_mask], t_train[batch_mask])
+        optimizer.update(network.params, grads)
+        peak = tracemalloc.get_traced_memory()[1] - base
+        if i < 3 or i == max_iterations - 1:
+            misses = "" if pool is None else ", pool misses = {}".format(pool.misses)
+            print("  iter {}: peak allocated = {:.1f} MB{}".format(i, peak / 2**20, misses))
+    tracemalloc.stop()
+    return time.perf_counter() - start
+
+
+print("no pool   : {:.2f} sec".format(train(None)))
+pool = BufferPool()
+elapsed = train(pool)
+print("buffer pool: {:.2f} sec, pool misses = {}".format(elapsed, pool.misses))
@@ -5,6 +5,7 @@ import pickle
 import numpy as np
 from collections import OrderedDict
 from common.layers import *
+from common.util import flatten_params, flat_views
 
 
 class DeepConvNet:
@@ -15,6 +16,11 @@ class DeepConvNet:
         conv - relu - conv- relu - pool -
         conv - relu - conv- relu - pool -
         affine - relu - dropout - affine - dropout - softmax
+
+    use_batchnorm : Trueの場合は各convと1つ目のaffineの直後（reluの前）にBatch Normalizationを入れる
+        （convの後はチャンネルごとのSpatialBatchNormalization）
+    conv_algo : Convolutionのforwardの計算方法（'im2col'、'winograd'、'fft'、'auto'）
+    dtype : パラメータのデータ型（e.g. np.float32）
     """
     def __init__(self, input_dim=(1, 28, 28),
                  conv_param_1 = {'filter_num':16, 'filter_size':3, 'pad':1, 'stride':1},
@@ -23,57 +29,76 @@ class DeepConvNet:
                  conv_param_4 = {'filter_num':32, 'filter_size':3, 'pad':2, 'stride':1},
                  conv_param_5 = {'filter_num':64, 'filter_size':3, 'pad':1, 'stride':1},
                  conv_param_6 = {'filter_num':64, 'filter_size':3, 'pad':1, 'stride':1},
-                 hidden_size=50, output_size=10):
+                 hidden_size=50, output_size=10, use_batchnorm=False, conv_algo='im2col',
+                 dtype=np.float64):
         # 重みの初期化===========
         # 各層のニューロンひとつあたりが、前層のニューロンといくつのつながりがあるか（TODO:自動で計算する）
         pre_node_nums = np.array([1*3*3, 16*3*3, 16*3*3, 32*3*3, 32*3*3, 64*3*3, 64*4*4, hidden_size])
         weight_init_scales = np.sqrt(2.0 / pre_node_nums)  # ReLUを使う場合に推奨される初期値
         
+        self.dtype = dtype
+        self.use_batchnorm = use_batchnorm
         self.params = {}
+        conv_params = [conv_param_1, conv_param_2, conv_param_3, conv_param_4, conv_param_5, conv_param_6]
         pre_channel_num = input_dim[0]
-        for idx, conv_param in enumerate([conv_param_1, conv_param_2, conv_param_3, conv_param_4, conv_param_5, conv_param_6]):
-            self.params['W' + str(idx+1)] = weight_init_scales[idx] * np.random.randn(conv_param['filter_num'], pre_channel_num, conv_param['filter_size'], conv_param['filter_size'])
-            self.params['b' + str(idx+1)] = np.zeros(conv_param['filter_num'])
+        for idx, conv_param in enumerate(conv_params):
+            self.params['W' + str(idx+1)] = (weight_init_scales[idx] * np.random.randn(conv_param['filter_num'], pre_channel_num, conv_param['filter_size'], conv_param['filter_size'])).astype(dtype)
+            self.params['b' + str(idx+1)] = np.zeros(conv_param['filter_num'], dtype=dtype)
+            if use_batchnorm:
+                self.params['gamma' + str(idx+1)] = np.ones(conv_param['filter_num'], dtype=dtype)
+                self.params['beta' + str(idx+1)] = np.zeros(conv_param['filter_num'], dtype=dtype)
             pre_channel_num = conv_param['filter_num']
-        self.params['W7'] = weight_init_scales[6] * np.random.randn(64*4*4, hidden_size)
-        self.params['b7'] = np.zeros(hidden_size)
-        self.params['W8'] = weight_init_scales[7] * np.random.randn(hidden_size, output_size)
-        self.params['b8'] = np.zeros(output_size)
-
-        # レイヤの生成===========
+        self.params['W7'] = (weight_init_scales[6] * np.random.randn(64*4*4, hidden_size)).astype(dtype)
+        self.params['b7'] = np.zeros(hidden_size, dtype=dtype)
+        if use_batchnorm:
+            self.params['gamma7'] = np.ones(hidden_size, dtype=dtype)
+            self.params['beta7'] = np.zeros(hidden_size, dtype=dtype)
+        self.params['W8'] = (weight_init_scales[7] * np.random.randn(hidden_size, output_size)).astype(dtype)
+        self.params['b8'] = np.zeros(output_size, dtype=dtype)
+
+        # パラメータと勾配はそれぞれ1つの連続したバッファのビューにする
+        # （オプティマイザはflat_params、flat_gradsをまとめて更新できる）
+        self.flat_params = flatten_params(self.params)
+        self.flat_grads = np.zeros_like(self.flat_params)
+        self.grads = flat_views(self.flat_grads, self.params)
+
+        # レイヤの生成（ReLUは直前の層の出力を上書きする）===========
         self.layers = []
-        self.layers.append(Convolution(self.params['W1'], self.params['b1'], 
-                           conv_param_1['stride'], conv_param_1['pad']))
-        self.layers.append(Relu())
-        self.layers.append(Convolution(self.params['W2'], self.params['b2'], 
-                           conv_param_2['stride'], conv_param_2['pad']))
-        self.layers.append(Relu())
-        self.layers.append(Pooling(pool_h=2, pool_w=2, stride=2))
-        self.layers.append(Convolution(self.params['W3'], self.params['b3'], 
-                           conv_param_3['stride'], conv_param_3['pad']))
-        self.layers.append(Relu())
-        self.layers.append(Convolution(self.params['W4'], self.params['b4'],
-                           conv_param_4['stride'], conv_param_4['pad']))
-        self.layers.append(Relu())
-        self.layers.append(Pooling(pool_h=2, pool_w=2, stride=2))
-        self.layers.append(Convolution(self.params['W5'], self.params['b5'],
-                           conv_param_5['stride'], conv_param_5['pad']))
-        self.layers.append(Relu())
-        self.layers.append(Convolution(self.params['W6'], self.params['b6'],
-                           conv_param_6['stride'], conv_param_6['pad']))
-        self.layers.append(Relu())
-        self.layers.append(Pooling(pool_h=2, pool_w=2, stride=2))
+        for idx, conv_param in enumerate(conv_params):
+            self.layers.append(Convolution(self.params['W' + str(idx+1)], self.params['b' + str(idx+1)],
+                               conv_param['stride'], conv_param['pad'], algo=conv_algo))
+            if use_batchnorm:
+                self.layers.append(SpatialBatchNormalization(self.params['gamma' + str(idx+1)],
+                                                             self.params['beta' + str(idx+1)]))
+            self.layers.append(Relu(inplace=True))
+            if idx % 2 == 1:
+                self.layers.append(Pooling(pool_h=2, pool_w=2, stride=2))
         self.layers.append(Affine(self.params['W7'], self.params['b7']))
-        self.layers.append(Relu())
+        if use_batchnorm:
+            self.layers.append(BatchNormalization(self.params['gamma7'], self.params['beta7']))
+        self.layers.append(Relu(inplace=True))
         self.layers.append(Dropout(0.5))
         self.layers.append(Affine(self.params['W8'], self.params['b8']))
         self.layers.append(Dropout(0.5))
-        
+        self.layers = fuse_relu(self.layers)
+        # 重みを持つレイヤの位置（Conv1~6、Affine1~2）
+        self.param_layer_idx = [i for i, layer in enumerate(self.layers)
+                                if isinstance(layer, (Convolution, Affine))]
+        for i, layer_idx in enumerate(self.param_layer_idx):
+            self.layers[layer_idx].dW = self.grads['W' + str(i+1)]
+            self.layers[layer_idx].db = self.grads['b' + str(i+1)]
+        # Batch Normalizationの位置（gamma1~7、beta1~7に対応）
+        self.bn_layer_idx = [i for i, layer in enumerate(self.layers)
+                             if isinstance(layer, BatchNormalization)]
+        for i, layer_idx in enumerate(self.bn_layer_idx):
+            self.layers[layer_idx].dgamma = self.grads['gamma' + str(i+1)]
+            self.layers[layer_idx].dbeta = self.grads['beta' + str(i+1)]
+
         self.last_layer = SoftmaxWithLoss()
 
     def predict(self, x, train_flg=False):
         for layer in self.layers:
-            if isinstance(layer, Dropout):
+            if isinstance(layer, (Dropout, BatchNormalization)):
                 x = layer.forward(x, train_flg)
             else:
                 x = layer.forward(x)
@@ -91,15 +116,16 @@ class DeepConvNet:
         for i in range(int(x.shape[0] / batch_size)):
             tx = x[i*batch_size:(i+1)*batch_size]
             tt = t[i*batch_size:(i+1)*batch_size]
-            y = self.predict(tx, train_flg=False)
+            with no_grad():
+                y = self.predict(tx, train_flg=False)
             y = np.argmax(y, axis=1)
             acc += np.sum(y == tt)
 
         return acc / x.shape[0]
 
     def gradient(self, x, t):
-        # forward
-        self.loss(x, t)
+        # forward（損失はlast_lossに保持し、もう一度forwardしなくて済むようにする）
+        self.last_loss = self.loss(x, t)
 
         # backward
         dout = 1
@@ -112,9 +138,12 @@ class DeepConvNet:
 
         # 設定
         grads = {}
-        for i, layer_idx in enumerate((0, 2, 5, 7, 10, 12, 15, 18)):
+        for i, layer_idx in enumerate(self.param_layer_idx):
             grads['W' + str(i+1)] = self.layers[layer_idx].dW
             grads['b' + str(i+1)] = self.layers[layer_idx].db
+        for i, layer_idx in enumerate(self.bn_layer_idx):
+            grads['gamma' + str(i+1)] = self.layers[layer_idx].dgamma
+            grads['beta' + str(i+1)] = self.layers[layer_idx].dbeta
 
         return grads
 
@@ -122,6 +151,11 @@ class DeepConvNet:
         params = {}
         for key, val in self.params.items():
             params[key] = val
+        params['inverted_dropout'] = True
+        # 推論時に使う移動平均も一緒に保存する
+        for i, layer_idx in enumerate(self.bn_layer_idx):
+            params['running_mean' + str(i+1)] = self.layers[layer_idx].running_mean
+            params['running_var' + str(i+1)] = self.layers[layer_idx].running_var
         with open(file_name, 'wb') as f:
             pickle.dump(params, f)
 
@@ -129,8 +163,16 @@ class DeepConvNet:
         with open(file_name, 'rb') as f:
             params = pickle.load(f)
         for key, val in params.items():
-            self.params[key] = val
-
-        for i, layer_idx in enumerate((0, 2, 5, 7, 10, 12, 15, 18)):
-            self.layers[layer_idx].W = self.params['W' + str(i+1)]
-            self.layers[layer_idx].b = self.params['b' + str(i+1)]
+            if key in self.params:
+                self.params[key][...] = val  # レイヤが参照するビューにそのまま書き込む
+        if 'inverted_dropout' not in params:
+            # Dropoutが推論時に(1-dropout_ratio)を掛けていた頃に保存したパラメータなので、
+            # その分を最後のAffineに畳み込んで同じ出力にする
+            # （affine - relu - dropout - affine - dropout の2つのDropout）
+            ratio1, ratio2 = [layer.dropout_ratio for layer in self.layers if isinstance(layer, Dropout)]
+            self.params['W8'] *= (1.0 - ratio1) * (1.0 - ratio2)
+            self.params['b8'] *= 1.0 - ratio2
+        for i, layer_idx in enumerate(self.bn_layer_idx):
+            if 'running_mean' + str(i+1) in params:
+                self.layers[layer_idx].running_mean = params['running_mean' + str(i+1)].astype(self.dtype)
+                self.layers[layer_idx].running_var = params['running_var' + str(i+1)].astype(self.dtype)
@@ -0,0 +1,37 @@
+# coding: utf-8
+import sys, os
+sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
+import time
+import numpy as np
+from deep_convnet import DeepConvNet
+from dataset.mnist import load_mnist
+from common.optimizer import Adam
+
+(x_train, t_train), (x_test, t_test) = load_mnist(flatten=False)
+
+max_iterations = 200
+batch_size = 100
+evaluate_sample_num = 1000
+
+
+def train(dtype):
+    np.random.seed(0)  # 重みの初期値とミニバッチを揃える
+    network = DeepConvNet(dtype=dtype)
+    optimizer = Adam(lr=0.001)
+    x = x_train.astype(dtype, copy=False)
+
+    start = time.perf_counter()
+    for i in range(max_iterations):
+        batch_mask = np.random.choice(x.shape[0], batch_size)
+        grads = network.gradient(x[batch_mask], t_train[batch_mask])
+        optimizer.update(network.params, grads)
+    elapsed = time.perf_counter() - start
+
+    acc = network.accuracy(x_test[:evaluate_sample_num].astype(dtype, copy=False),
+                           t_test[:evaluate_sample_num])
+    return max_iterations * batch_size / elapsed, acc
+
+
+for dtype in (np.float64, np.float32):
+    throughput, acc = train(dtype)
+    print("{:<8} {:>10.1f} samples/sec, test acc: {:.4f}".format(np.dtype(dtype).name, throughput, acc))
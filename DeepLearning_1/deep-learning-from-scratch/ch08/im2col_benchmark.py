@@ -0,0 +1,40 @@
+# coding: utf-8
+import sys, os
+sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
+import time
+import numpy as np
+from common.util import im2col, im2col_strided
+
+
+def benchmark(func, x, filter_size, stride, pad, repeat=10):
+    func(x, filter_size, filter_size, stride, pad)  # ウォームアップ
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(x, filter_size, filter_size, stride, pad)
+    return (time.perf_counter() - start) / repeat
+
+
+# DeepConvNetの各層の入力形状（バッチサイズ100）
+batch_size = 100
+layer_shapes = [
+    # (名前, 入力形状, フィルターサイズ, ストライド, パディング)
+    ('conv1', (batch_size, 1, 28, 28), 3, 1, 1),
+    ('conv2', (batch_size, 16, 28, 28), 3, 1, 1),
+    ('pool1', (batch_size, 16, 28, 28), 2, 2, 0),
+    ('conv3', (batch_size, 16, 14, 14), 3, 1, 1),
+    ('conv4', (batch_size, 32, 14, 14), 3, 1, 2),
+    ('pool2', (batch_size, 32, 16, 16), 2, 2, 0),
+    ('conv5', (batch_size, 32, 8, 8), 3, 1, 1),
+    ('conv6', (batch_size, 64, 8, 8), 3, 1, 1),
+    ('pool3', (batch_size, 64, 8, 8), 2, 2, 0),
+]
+
+print("{:<6} {:>12} {:>12} {:>8}".format("layer", "im2col[ms]", "strided[ms]", "speedup"))
+for name, shape, filter_size, stride, pad in layer_shapes:
+    x = np.random.randn(*shape)
+    assert np.array_equal(im2col(x, filter_size, filter_size, stride, pad),
+                          im2col_strided(x, filter_size, filter_size, stride, pad))
+
+    t_loop = benchmark(im2col, x, filter_size, stride, pad)
+    t_strided = benchmark(im2col_strided, x, filter_size, stride, pad)
+    print("{:<6} {:>12.3f} {:>12.3f} {:>7.2f}x".format(name, t_loop*1000, t_strided*1000, t_loop/t_strided))
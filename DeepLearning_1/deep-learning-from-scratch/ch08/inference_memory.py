@@ -0,0 +1,33 @@
+# coding: utf-8
+import sys, os
+sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
+import tracemalloc
+import numpy as np
+from deep_convnet import DeepConvNet
+from common.layers import no_grad
+
+batch_size = 1000
+x = np.random.rand(batch_size, 1, 28, 28).astype(np.float32)
+
+
+def peak_memory(predict):
+    tracemalloc.start()
+    predict()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def predict_with_cache():
+    network.predict(x, train_flg=False)
+
+
+def predict_without_cache():
+    with no_grad():
+        network.predict(x, train_flg=False)
+
+
+for name, predict in (('predict', predict_with_cache), ('no_grad', predict_without_cache)):
+    network = DeepConvNet()  # 中間データが残っていない状態から測る
+    network.load_params("deep_convnet_params.pkl")
+    print("{:<8} peak memory: {:.1f} MB".format(name, peak_memory(predict) / 1024**2))
@@ -5,6 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from deep_convnet import DeepConvNet
 from dataset.mnist import load_mnist
+from common.layers import no_grad
 
 
 (x_train, t_train), (x_test, t_test) = load_mnist(flatten=False)
@@ -25,7 +26,8 @@ batch_size = 100
 for i in range(int(x_test.shape[0] / batch_size)):
     tx = x_test[i*batch_size:(i+1)*batch_size]
     tt = t_test[i*batch_size:(i+1)*batch_size]
-    y = network.predict(tx, train_flg=False)
+    with no_grad():
+        y = network.predict(tx, train_flg=False)
     y = np.argmax(y, axis=1)
     classified_ids.append(y)
     acc += np.sum(y == tt)
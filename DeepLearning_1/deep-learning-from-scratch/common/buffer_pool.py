@@ -0,0 +1,62 @@
+# coding: utf-8
+import contextlib
+import threading
+import numpy as np
+
+
+class BufferPool:
+    """(形状, データ型, 役割)ごとに配列を確保して使い回すプール
+
+    訓練中はミニバッチの形状が変わらないため、2回目以降のステップでは
+    プールの配列を新しく確保しない。missesはプールに無く新しく確保した回数で、
+    プール以外で確保される配列（平均や分散などの小さな配列）は数えない
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.misses = 0
+
+    def get(self, shape, dtype, role):
+        key = (tuple(shape), np.dtype(dtype), role)
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buf
+            self.misses += 1
+        return buf
+
+    def clear(self):
+        self.buffers = {}
+
+
+_state = threading.local()
+
+
+@contextlib.contextmanager
+def using_buffer_pool(pool):
+    """このブロック内では、各レイヤの出力や中間データをpoolから取り出す
+
+    取り出した配列は次のステップで上書きされるため、結果を残す場合はコピーする
+    """
+    old_pool = getattr(_state, 'pool', None)
+    _state.pool = pool
+    try:
+        yield pool
+    finally:
+        _state.pool = old_pool
+
+
+def empty(shape, dtype, role):
+    """有効なプールがあればそこから、なければ新しく配列を確保する（中身は不定）
+
+    roleがNoneの場合は他と共有できないため、常に新しく確保する
+    """
+    pool = getattr(_state, 'pool', None)
+    if pool is None or role is None:
+        return np.empty(shape, dtype=dtype)
+    return pool.get(shape, dtype, role)
+
+
+def zeros(shape, dtype, role):
+    buf = empty(shape, dtype, role)
+    buf.fill(0)
+    return buf
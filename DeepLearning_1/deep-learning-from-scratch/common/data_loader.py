@@ -0,0 +1,103 @@
+# coding: utf-8
+import threading
+import queue
+import numpy as np
+
+
+class DataLoader:
+    """ミニバッチを順に取り出すクラス
+
+    エポックごとに一度だけデータの並びをシャッフルし、重複なしでミニバッチを作る。
+    prefetchがTrueの場合は、次のミニバッチを別スレッドで確保済みのバッファに詰めておく
+
+    Parameters
+    ----------
+    x : 訓練データ
+    t : 教師データ
+    batch_size : ミニバッチのサイズ
+    shuffle : エポックごとにシャッフルするかどうか
+    drop_last : batch_sizeに満たない最後のミニバッチを捨てるかどうか
+    prefetch : 別スレッドで次のミニバッチを用意するかどうか
+    num_buffers : prefetchで使い回すバッファの数
+
+    prefetch時はバッファを使い回すため、返したミニバッチは次のミニバッチを
+    取り出すまでの間だけ有効
+    """
+    def __init__(self, x, t, batch_size=100, shuffle=True, drop_last=False,
+                 prefetch=True, num_buffers=2):
+        self.x = x
+        self.t = t
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.num_buffers = num_buffers
+        self.data_size = x.shape[0]
+
+        self.buffers = None
+
+    def __len__(self):
+        if self.drop_last:
+            return self.data_size // self.batch_size
+        return -(-self.data_size // self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.permutation(self.data_size)
+        else:
+            indices = np.arange(self.data_size)
+        batch_indices = [indices[i*self.batch_size:(i+1)*self.batch_size] for i in range(len(self))]
+
+        if not self.prefetch:
+            return ((self.x[idx], self.t[idx]) for idx in batch_indices)
+        return self._iter_prefetch(batch_indices)
+
+    def _iter_prefetch(self, batch_indices):
+        if self.buffers is None:
+            self.buffers = []
+            for _ in range(self.num_buffers):
+                self.buffers.append((np.empty((self.batch_size,) + self.x.shape[1:], dtype=self.x.dtype),
+                                     np.empty((self.batch_size,) + self.t.shape[1:], dtype=self.t.dtype)))
+
+        free = queue.Queue()  # 書き込んでよいバッファの番号
+        ready = queue.Queue()  # 詰め終わったミニバッチ
+        for i in range(self.num_buffers):
+            free.put(i)
+
+        def worker():
+            try:
+                for idx in batch_indices:
+                    i = free.get()
+                    if i is None:  # 途中で打ち切られた
+                        return
+                    x_buf, t_buf = self.buffers[i]
+                    x_batch, t_batch = x_buf[:len(idx)], t_buf[:len(idx)]
+                    _gather(self.x, idx, x_batch)
+                    _gather(self.t, idx, t_batch)
+                    ready.put((i, x_batch, t_batch))
+                ready.put(None)
+            except Exception as e:
+                ready.put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                i, x_batch, t_batch = item
+                yield x_batch, t_batch
+                free.put(i)
+        finally:
+            free.put(None)
+            thread.join()
+
+
+def _gather(src, idx, out):
+    if isinstance(src, np.ndarray):
+        np.take(src, idx, axis=0, out=out)
+    else:
+        out[...] = src[idx]
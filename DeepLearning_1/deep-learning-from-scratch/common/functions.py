@@ -29,8 +29,11 @@ def relu_grad(x):
     
 
 def softmax(x):
-    x = x - np.max(x, axis=-1, keepdims=True)   # オーバーフロー対策
-    return np.exp(x) / np.sum(np.exp(x), axis=-1, keepdims=True)
+    # オーバーフロー対策（整数の入力でもその場でexpを取れるように浮動小数点数にする）
+    x = np.subtract(x, np.max(x, axis=-1, keepdims=True), dtype=np.result_type(x.dtype, np.float32))
+    np.exp(x, out=x)
+    x /= np.sum(x, axis=-1, keepdims=True)
+    return x
 
 
 def sum_squared_error(y, t):
@@ -50,6 +53,42 @@ def cross_entropy_error(y, t):
     return -np.sum(np.log(y[np.arange(batch_size), t] + 1e-7)) / batch_size
 
 
+def softmax_cross_entropy(x, t, out=None):
+    """softmaxとcross_entropy_errorをまとめて計算する
+
+    損失はlog-sum-expで求めるため、expは1回だけで済み、logの中に微小な値を足す必要もない
+
+    Parameters
+    ----------
+    x : 入力（ソフトマックス関数に入力する値）
+    t : 教師データ（ラベルまたはone-hot-vector）
+    out : ソフトマックス関数の出力を書き込む配列（xと同じ形状）
+
+    Returns
+    -------
+    loss, y : 損失関数の値とソフトマックス関数の出力
+    """
+    if x.ndim == 1:
+        t = t.reshape(1, t.size)
+        x = x.reshape(1, x.size)
+        if out is not None:
+            out = out.reshape(1, out.size)
+
+    batch_size = x.shape[0]
+    dtype = np.result_type(x.dtype, np.float32) if out is None else out.dtype  # 整数の入力でもexpを取れるように
+    y = np.subtract(x, np.max(x, axis=1, keepdims=True), out=out, dtype=dtype)   # オーバーフロー対策
+    if t.size == y.size: # 教師データがone-hot-vectorの場合
+        picked = np.einsum('ij,ij->i', y, t)
+    else:
+        picked = y[np.arange(batch_size), t.ravel()]
+
+    np.exp(y, out=y)
+    exp_sum = np.sum(y, axis=1)
+    loss = np.sum(np.log(exp_sum) - picked) / batch_size
+
+    y /= exp_sum[:, np.newaxis]
+    return loss, y
+
+
 def softmax_loss(X, t):
-    y = softmax(X)
-    return cross_entropy_error(y, t)
+    return softmax_cross_entropy(X, t)[0]
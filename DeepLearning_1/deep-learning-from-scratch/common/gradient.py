@@ -1,4 +1,5 @@
 # coding: utf-8
+import multiprocessing
 import numpy as np
 
 def _numerical_gradient_1d(f, x):
@@ -31,7 +32,15 @@ def numerical_gradient_2d(f, X):
         return grad
 
 
-def numerical_gradient(f, x):
+def numerical_gradient(f, x, processes=None):
+    """数値微分による勾配
+
+    processesを指定すると、xの要素を分けてprocesses個のプロセスで並列に求める
+    （forkでプロセスを作るため、fやxをpickleできなくてもよい。Windowsでは使えない）
+    """
+    if processes is not None:
+        return _numerical_gradient_parallel(f, x, processes)
+
     h = 1e-4 # 0.0001
     grad = np.zeros_like(x)
     
@@ -50,3 +59,153 @@ def numerical_gradient(f, x):
         it.iternext()   
         
     return grad
+
+
+def numerical_gradient_batch(f, x, batch_size=64):
+    """xの要素をbatch_size個ずつ同時にずらしてまとめて損失を求める数値微分
+
+    要素ごとに+h、-hしたxのコピーを先頭の軸に重ね、fを1回呼ぶだけで2*batch_size個の損失を得る
+
+    Parameters
+    ----------
+    f : (k,) + x.shapeの配列を受け取り、k個の損失を並べた配列を返す関数
+    x : 微分するパラメータ
+    batch_size : 一度にずらす要素の数
+
+    Returns
+    -------
+    grad : xと同じ形状の勾配
+    """
+    h = 1e-4 # 0.0001
+    grad = np.zeros(x.shape, dtype=x.dtype)
+    grad_flat = grad.reshape(-1)
+    x_flat = x.reshape(-1)
+
+    k = min(batch_size, x.size)
+    rows = np.arange(k)
+    X = np.empty((2*k, x.size), dtype=x.dtype)
+    X[:] = x_flat
+    for start in range(0, x.size, k):
+        idx = np.arange(start, min(start + k, x.size))
+        n = idx.size
+        X[rows[:n], idx] = x_flat[idx] + h
+        X[k + rows[:n], idx] = x_flat[idx] - h
+
+        fx = f(X.reshape((2*k,) + x.shape))
+        grad_flat[idx] = (fx[:n] - fx[k:k + n]) / (2*h)
+
+        X[rows[:n], idx] = x_flat[idx] # 値を元に戻す
+        X[k + rows[:n], idx] = x_flat[idx]
+
+    return grad
+
+
+_worker_args = None  # forkしたプロセスに引き継ぐ(f, x)
+
+
+def _numerical_gradient_indices(indices):
+    f, x = _worker_args
+    h = 1e-4 # 0.0001
+    grad = np.zeros(indices.size, dtype=x.dtype)
+
+    for i, flat_idx in enumerate(indices):
+        idx = np.unravel_index(flat_idx, x.shape)
+        tmp_val = x[idx]
+        x[idx] = tmp_val + h
+        fxh1 = f(x) # f(x+h)
+
+        x[idx] = tmp_val - h
+        fxh2 = f(x) # f(x-h)
+        grad[i] = (fxh1 - fxh2) / (2*h)
+
+        x[idx] = tmp_val # 値を元に戻す
+
+    return grad
+
+
+def _numerical_gradient_parallel(f, x, processes):
+    global _worker_args
+    # 要素ごとの計算量はほぼ同じなので、プロセス数の数倍に分けて偏りを抑える
+    chunks = np.array_split(np.arange(x.size), min(x.size, processes * 4))
+
+    _worker_args = (f, x)
+    try:
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.map(_numerical_gradient_indices, chunks)
+    finally:
+        _worker_args = None
+
+    grad = np.zeros(x.shape, dtype=x.dtype)
+    grad.reshape(-1)[np.concatenate(chunks)] = np.concatenate(results)
+    return grad
+
+
+def gradient_check(f, params, grads, num_samples=10, num_directions=0, seed=None, h=None, atol=None):
+    """誤差逆伝播法で求めた勾配を、ランダムに選んだ要素だけ数値微分と比べる
+
+    すべての要素を数値微分するとパラメータの数の2倍だけforwardが必要になるが、
+    パラメータごとにnum_samples個の要素に絞るため大きなネットワークでもすぐに終わる
+
+    Parameters
+    ----------
+    f : 損失を返す関数（paramsの値をその場で書き換えてから呼ぶ）
+    params : パラメータのディクショナリ
+    grads : 誤差逆伝播法で求めた勾配のディクショナリ
+    num_samples : パラメータごとに調べる要素の数（Noneの場合はすべての要素）
+    num_directions : パラメータごとに、ランダムな方向への方向微分 (f(W+hd) - f(W-hd)) / 2h と
+        勾配とdの内積もこの回数だけ比べる（1方向につきforward 2回）
+    seed : 要素や方向を選ぶ乱数のシード
+    h : 数値微分の幅。Noneの場合、float64のパラメータは1e-6、それ以外は1e-3
+        （幅が大きいとReLUやMax Poolingの折れ目をまたいで、正しい勾配でも誤差が大きくなる。
+        float32では丸め誤差のため小さくしすぎない）
+    atol : 誤差の分母に加える値（勾配がほぼ0の要素で相対誤差が大きくならないように）
+        Noneの場合、float64のパラメータは1e-7、それ以外は1e-2
+        （float32では損失の丸め誤差が数値微分に1e-4程度の誤差を生むため、確認はfloat64で行うとよい）
+
+    Returns
+    -------
+    errors : パラメータごとの最大誤差 |a - b| / (max(|a|, |b|) + atol) のディクショナリ
+    """
+    rng = np.random.default_rng(seed)
+    errors = {}
+
+    for key, x in params.items():
+        grad = grads[key]
+        is_float64 = x.dtype == np.float64
+        h_key = h if h is not None else (1e-6 if is_float64 else 1e-3)
+        atol_key = atol if atol is not None else (1e-7 if is_float64 else 1e-2)
+        size = x.size if num_samples is None else min(num_samples, x.size)
+        numerical, analytic = [], []
+
+        for flat_idx in rng.choice(x.size, size, replace=False):
+            idx = np.unravel_index(flat_idx, x.shape)
+            tmp_val = x[idx]
+            x[idx] = tmp_val + h_key
+            fxh1 = f(x) # f(x+h)
+
+            x[idx] = tmp_val - h_key
+            fxh2 = f(x) # f(x-h)
+            numerical.append((fxh1 - fxh2) / (2*h_key))
+            analytic.append(grad[idx])
+
+            x[idx] = tmp_val # 値を元に戻す
+
+        for _ in range(num_directions):
+            d = rng.standard_normal(x.shape).astype(x.dtype, copy=False)
+            d /= np.sqrt(np.sum(d * d))
+            tmp_val = x.copy()
+            x += h_key * d
+            fxh1 = f(x)
+
+            x[...] = tmp_val - h_key * d
+            fxh2 = f(x)
+            numerical.append((fxh1 - fxh2) / (2*h_key))
+            analytic.append(np.sum(grad * d))
+
+            x[...] = tmp_val # 値を元に戻す
+
+        numerical, analytic = np.array(numerical), np.array(analytic)
+        scale = np.maximum(np.abs(numerical), np.abs(analytic)) + atol_key
+        errors[key] = float(np.max(np.abs(numerical - analytic) / scale))
+
+    return errors
@@ -1,14 +1,81 @@
 # coding: utf-8
+import contextlib
+import copy
+import threading
+import time
 import numpy as np
 from common.functions import *
-from common.util import im2col, col2im
+from common import buffer_pool
+from common.util import im2col, im2col_strided, col2im, col2im_vectorized, winograd_conv, fft_conv
+
+
+class Config(threading.local):
+    """レイヤの動作設定（スレッドごとに独立）"""
+    enable_backprop = True
+
+config = Config()
+
+
+@contextlib.contextmanager
+def using_config(name, value):
+    old_value = getattr(config, name)
+    setattr(config, name, value)
+    try:
+        yield
+    finally:
+        setattr(config, name, old_value)
+
+
+def no_grad():
+    """推論モード：各レイヤはbackward用の中間データを保持しない"""
+    return using_config('enable_backprop', False)
+
+
+def _buffer(layer, name, shape, dtype):
+    """レイヤごとの配列を有効なバッファプールから取り出す（プールがなければ新しく確保する）"""
+    return buffer_pool.empty(shape, dtype, (id(layer), name))
+
+
+def _grad_buffer(layer, name, shape, dtype):
+    """勾配の格納先：形状とデータ型が合う配列が設定済みならそれに上書きする
+
+    ネットワークがパラメータと同様に勾配も1つのバッファのビューとして渡しておけば、
+    backwardのたびに新しい配列を作らずにそのバッファへ書き込む
+    """
+    buf = getattr(layer, name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = _buffer(layer, name, shape, dtype)
+    return buf
+
+
+def _dot(a, b, out):
+    """np.dot(a, b)をoutに書き込む（データ型が異なる場合は変換して書き込む）"""
+    if np.result_type(a, b) == out.dtype:
+        return np.dot(a, b, out=out)
+    out[...] = np.dot(a, b)
+    return out
 
 
 class Relu:
-    def __init__(self):
+    """
+    inplace : Trueの場合は入力を上書きして出力する（入力を他で使わない場合のみ）
+        backward用のマスクは(x > 0)をpositiveに保持し、同じ形状ならバッファを使い回す
+    """
+    def __init__(self, inplace=False):
+        self.inplace = inplace
         self.mask = None
+        self.positive = None
 
     def forward(self, x):
+        if not config.enable_backprop:
+            return np.maximum(x, 0, out=x if self.inplace else None)
+
+        if self.inplace:
+            if self.positive is None or self.positive.shape != x.shape:
+                self.positive = np.empty(x.shape, dtype=bool)
+            np.greater(x, 0, out=self.positive)
+            return np.maximum(x, 0, out=x)
+
         self.mask = (x <= 0)
         out = x.copy()
         out[self.mask] = 0
@@ -16,6 +83,10 @@ class Relu:
         return out
 
     def backward(self, dout):
+        if self.inplace:
+            # ブールインデックスでの代入より、マスクを掛ける方が分岐がなく速い
+            return np.multiply(dout, self.positive, out=dout)
+
         dout[self.mask] = 0
         dx = dout
 
@@ -28,7 +99,8 @@ class Sigmoid:
 
     def forward(self, x):
         out = sigmoid(x)
-        self.out = out
+        if config.enable_backprop:
+            self.out = out
         return out
 
     def backward(self, dout):
@@ -50,44 +122,54 @@ class Affine:
 
     def forward(self, x):
         # テンソル対応
-        self.original_x_shape = x.shape
+        original_x_shape = x.shape
         x = x.reshape(x.shape[0], -1)
-        self.x = x
+        if config.enable_backprop:
+            self.original_x_shape = original_x_shape
+            self.x = x
 
-        out = np.dot(self.x, self.W) + self.b
+        out = _buffer(self, 'out', (x.shape[0], self.W.shape[1]), np.result_type(x, self.W))
+        np.dot(x, self.W, out=out)
+        out += self.b
 
         return out
 
     def backward(self, dout):
-        dx = np.dot(dout, self.W.T)
-        self.dW = np.dot(self.x.T, dout)
-        self.db = np.sum(dout, axis=0)
+        dx = np.dot(dout, self.W.T, out=_buffer(self, 'dx', self.x.shape, np.result_type(dout, self.W)))
+        self.dW = _dot(self.x.T, dout, _grad_buffer(self, 'dW', self.W.shape, self.W.dtype))
+        self.db = np.sum(dout, axis=0, out=_grad_buffer(self, 'db', self.b.shape, self.b.dtype))
         
         dx = dx.reshape(*self.original_x_shape)  # 入力データの形状に戻す（テンソル対応）
         return dx
 
 
 class SoftmaxWithLoss:
+    """
+    backwardはsoftmaxの出力yをその場で勾配に書き換えるため、forward 1回につき1回だけ呼べる
+    """
     def __init__(self):
         self.loss = None
         self.y = None # softmaxの出力
         self.t = None # 教師データ
 
     def forward(self, x, t):
-        self.t = t
-        self.y = softmax(x)
-        self.loss = cross_entropy_error(self.y, self.t)
+        y = _buffer(self, 'y', x.shape, np.result_type(x.dtype, np.float32))
+        self.loss, y = softmax_cross_entropy(x, t, out=y)
+        if config.enable_backprop:
+            self.t = t
+            self.y = y
         
         return self.loss
 
     def backward(self, dout=1):
         batch_size = self.t.shape[0]
+        dx = self.y
         if self.t.size == self.y.size: # 教師データがone-hot-vectorの場合
-            dx = (self.y - self.t) / batch_size
+            dx -= self.t
         else:
-            dx = self.y.copy()
             dx[np.arange(batch_size), self.t] -= 1
-            dx = dx / batch_size
+        dx /= batch_size
+        self.y = None
         
         return dx
 
@@ -95,25 +177,59 @@ class SoftmaxWithLoss:
 class Dropout:
     """
     http://arxiv.org/abs/1207.0580
+
+    訓練時に残したニューロンの出力を1/(1-dropout_ratio)倍しておく（inverted dropout）ため、
+    推論時は入力をそのまま返す。マスクは層ごとの乱数生成器でfloat32の乱数から作る
+
+    Parameters
+    ----------
+    dropout_ratio : 出力を0にする割合
+    seed : 乱数のシード（同じシードなら同じマスクの列になる）
+        Noneの場合はnp.random（従来のグローバルな乱数）から決めるため、
+        np.random.seed()で重みの初期値と同様にマスクも再現できる
+    packbits : Trueの場合、backward用のマスクを1要素1ビットに詰めて保持する
     """
-    def __init__(self, dropout_ratio=0.5):
+    def __init__(self, dropout_ratio=0.5, seed=None, packbits=False):
         self.dropout_ratio = dropout_ratio
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.rng = np.random.default_rng(seed)
+        self.packbits = packbits
         self.mask = None
+        self.mask_shape = None
+        self.rand = None  # 乱数を書き込むバッファ（形状が変わらなければ使い回す）
 
     def forward(self, x, train_flg=True):
-        if train_flg:
-            self.mask = np.random.rand(*x.shape) > self.dropout_ratio
-            return x * self.mask
-        else:
-            return x * (1.0 - self.dropout_ratio)
+        if not train_flg:
+            return x
+
+        if self.rand is None or self.rand.shape != x.shape:
+            self.rand = np.empty(x.shape, dtype=np.float32)
+        self.rng.random(dtype=np.float32, out=self.rand)
+        mask = np.greater(self.rand, self.dropout_ratio, out=_buffer(self, 'mask', x.shape, np.bool_))
+
+        out = np.multiply(x, mask, out=_buffer(self, 'out', x.shape, x.dtype))
+        out *= 1.0 / (1.0 - self.dropout_ratio)
+        if config.enable_backprop:
+            self.mask = np.packbits(mask) if self.packbits else mask
+            self.mask_shape = x.shape
+        return out
 
     def backward(self, dout):
-        return dout * self.mask
+        mask = self.mask
+        if self.packbits:
+            mask = np.unpackbits(mask, count=int(np.prod(self.mask_shape))).view(np.bool_).reshape(self.mask_shape)
+        dx = np.multiply(dout, mask, out=_buffer(self, 'dx', dout.shape, dout.dtype))
+        dx *= 1.0 / (1.0 - self.dropout_ratio)
+        return dx
 
 
 class BatchNormalization:
     """
     http://arxiv.org/abs/1502.03167
+
+    正規化した入力xnと標準偏差の逆数inv_stdだけを保持し、
+    backwardはまとめた式 dx = inv_std/N * (N*dxn - Σdxn - xn*Σ(dxn*xn)) で求める
     """
     def __init__(self, gamma, beta, momentum=0.9, running_mean=None, running_var=None):
         self.gamma = gamma
@@ -126,9 +242,8 @@ class BatchNormalization:
         self.running_var = running_var  
         
         # backward時に使用する中間データ
-        self.batch_size = None
-        self.xc = None
-        self.std = None
+        self.xn = None
+        self.inv_std = None
         self.dgamma = None
         self.dbeta = None
 
@@ -145,27 +260,32 @@ class BatchNormalization:
     def __forward(self, x, train_flg):
         if self.running_mean is None:
             N, D = x.shape
-            self.running_mean = np.zeros(D)
-            self.running_var = np.zeros(D)
-                        
+            self.running_mean = np.zeros(D, dtype=x.dtype)
+            self.running_var = np.zeros(D, dtype=x.dtype)
+
+        out = _buffer(self, 'out', x.shape, np.result_type(x, self.gamma))
         if train_flg:
             mu = x.mean(axis=0)
-            xc = x - mu
-            var = np.mean(xc**2, axis=0)
-            std = np.sqrt(var + 10e-7)
-            xn = xc / std
-            
-            self.batch_size = x.shape[0]
-            self.xc = xc
-            self.xn = xn
-            self.std = std
-            self.running_mean = self.momentum * self.running_mean + (1-self.momentum) * mu
-            self.running_var = self.momentum * self.running_var + (1-self.momentum) * var            
+            xn = _buffer(self, 'xn', x.shape, out.dtype)
+            np.subtract(x, mu, out=xn)  # xc
+            var = np.einsum('ij,ij->j', xn, xn) / x.shape[0]  # xc**2を作らずに分散を求める
+            inv_std = 1.0 / np.sqrt(var + 10e-7)
+            xn *= inv_std
+
+            if config.enable_backprop:
+                self.xn = xn
+                self.inv_std = inv_std
+            self.running_mean *= self.momentum
+            self.running_mean += (1-self.momentum) * mu
+            self.running_var *= self.momentum
+            self.running_var += (1-self.momentum) * var
+            np.multiply(xn, self.gamma, out=out)
         else:
-            xc = x - self.running_mean
-            xn = xc / ((np.sqrt(self.running_var + 10e-7)))
-            
-        out = self.gamma * xn + self.beta 
+            # gamma / sqrt(running_var)をまとめて1回だけ掛ける
+            np.subtract(x, self.running_mean, out=out)
+            out *= self.gamma / np.sqrt(self.running_var + 10e-7)
+
+        out += self.beta
         return out
 
     def backward(self, dout):
@@ -179,15 +299,19 @@ class BatchNormalization:
         return dx
 
     def __backward(self, dout):
-        dbeta = dout.sum(axis=0)
-        dgamma = np.sum(self.xn * dout, axis=0)
-        dxn = self.gamma * dout
-        dxc = dxn / self.std
-        dstd = -np.sum((dxn * self.xc) / (self.std * self.std), axis=0)
-        dvar = 0.5 * dstd / self.std
-        dxc += (2.0 / self.batch_size) * self.xc * dvar
-        dmu = np.sum(dxc, axis=0)
-        dx = dxc - dmu / self.batch_size
+        N = dout.shape[0]
+        dbeta = np.sum(dout, axis=0, out=_grad_buffer(self, 'dbeta', self.beta.shape, self.beta.dtype))
+        dgamma = np.einsum('ij,ij->j', self.xn, dout,
+                           out=_grad_buffer(self, 'dgamma', self.gamma.shape, self.gamma.dtype),
+                           casting='same_kind')
+
+        # dxn = gamma * doutなので、Σdxn = gamma * dbeta、Σ(dxn*xn) = gamma * dgamma
+        # dx = gamma * inv_std * (dout - (dbeta + xn*dgamma) / N)
+        dx = np.multiply(self.xn, dgamma, out=_buffer(self, 'dx', dout.shape, np.result_type(dout, self.xn)))
+        dx += dbeta
+        dx *= -1.0 / N
+        dx += dout
+        dx *= self.gamma * self.inv_std
         
         self.dgamma = dgamma
         self.dbeta = dbeta
@@ -195,12 +319,52 @@ class BatchNormalization:
         return dx
 
 
+class SpatialBatchNormalization(BatchNormalization):
+    """畳み込み層の出力(N, C, H, W)用のBatch Normalization
+
+    チャンネルごとに(N, H, W)全体で平均と分散を求めるため、gamma、beta、running_mean、
+    running_varの形状は(C,)。Convolutionの出力はメモリ上(N, H, W, C)の順に並んでいるので、
+    コピーせずに(N*H*W, C)のビューとして全結合層の場合と同じ計算を行う
+    """
+    def forward(self, x, train_flg=True):
+        N, C, H, W = x.shape
+        out = super().forward(x.transpose(0, 2, 3, 1).reshape(-1, C), train_flg)
+        return out.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+
+    def backward(self, dout):
+        N, C, H, W = dout.shape
+        dx = super().backward(dout.transpose(0, 2, 3, 1).reshape(-1, C))
+        return dx.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+
+
+# algo='auto'で選んだ計算方法（入力とフィルターの形状ごと）
+_conv_algo_cache = {}
+
+
 class Convolution:
-    def __init__(self, W, b, stride=1, pad=0):
+    """
+    vectorized : Trueの場合はim2col_strided、col2im_vectorizedを使う
+    algo : forwardの計算方法
+        'im2col' : im2colと行列積
+        'winograd' : Winograd F(2x2, 3x3)（3x3、ストライド1のフィルターのみ）
+        'fft' : FFT（大きなフィルター向け）
+        'auto' : 推論モード（no_grad）では形状ごとに最初の1回だけ各方法の時間を計り、
+            最も速い方法を使う。backwardにはcolが必要なため、学習時はim2colを使う
+        im2col以外の場合、backwardでは保持した入力からcolを計算し直す
+    """
+    def __init__(self, W, b, stride=1, pad=0, vectorized=False, algo='im2col'):
+        if algo not in ('im2col', 'winograd', 'fft', 'auto'):
+            raise ValueError("unknown algo: " + str(algo))
+        if algo == 'winograd' and (W.shape[2:] != (3, 3) or stride != 1):
+            raise ValueError("winograd supports only 3x3 filters with stride 1")
         self.W = W
         self.b = b
         self.stride = stride
         self.pad = pad
+        self.vectorized = vectorized
+        self.algo = algo
+        self.im2col = im2col_strided if vectorized else im2col
+        self.col2im = col2im_vectorized if vectorized else col2im
         
         # 中間データ（backward時に使用）
         self.x = None   
@@ -212,73 +376,293 @@ class Convolution:
         self.db = None
 
     def forward(self, x):
+        return self._forward(x, self._select_algo(x))
+
+    def _forward(self, x, algo):
         FN, C, FH, FW = self.W.shape
         N, C, H, W = x.shape
         out_h = 1 + int((H + 2*self.pad - FH) / self.stride)
         out_w = 1 + int((W + 2*self.pad - FW) / self.stride)
 
-        col = im2col(x, FH, FW, self.stride, self.pad)
-        col_W = self.W.reshape(FN, -1).T
-
-        out = np.dot(col, col_W) + self.b
+        col = col_W = None
+        if algo == 'im2col':
+            col = self.im2col(x, FH, FW, self.stride, self.pad, role=id(self))
+            col_W = self.W.reshape(FN, -1).T
+
+            out = _buffer(self, 'out', (col.shape[0], FN), np.result_type(col, col_W))
+            np.dot(col, col_W, out=out)
+        elif algo == 'winograd':
+            out = winograd_conv(x, self.W, self.pad, role=id(self))
+        elif algo == 'fft':
+            out = fft_conv(x, self.W, self.stride, self.pad, role=id(self))
+        out += self.b
         out = out.reshape(N, out_h, out_w, -1).transpose(0, 3, 1, 2)
 
-        self.x = x
-        self.col = col
-        self.col_W = col_W
+        if config.enable_backprop:
+            self.x = x
+            self.col = col
+            self.col_W = col_W
 
         return out
 
+    def _select_algo(self, x):
+        if self.algo != 'auto':
+            return self.algo
+        if config.enable_backprop:
+            return 'im2col'
+
+        key = (x.shape, x.dtype, self.W.shape, self.W.dtype, self.stride, self.pad, self.vectorized)
+        if key not in _conv_algo_cache:
+            algos = ['im2col', 'fft']
+            if self.W.shape[2:] == (3, 3) and self.stride == 1:
+                algos.append('winograd')
+            times = {}
+            for algo in algos:
+                start = time.perf_counter()
+                self._forward(x, algo)
+                times[algo] = time.perf_counter() - start
+            _conv_algo_cache[key] = min(times, key=times.get)
+        return _conv_algo_cache[key]
+
     def backward(self, dout):
         FN, C, FH, FW = self.W.shape
-        dout = dout.transpose(0,2,3,1).reshape(-1, FN)
-
-        self.db = np.sum(dout, axis=0)
-        self.dW = np.dot(self.col.T, dout)
-        self.dW = self.dW.transpose(1, 0).reshape(FN, C, FH, FW)
-
-        dcol = np.dot(dout, self.col_W.T)
-        dx = col2im(dcol, self.x.shape, FH, FW, self.stride, self.pad)
+        N, _, out_h, out_w = dout.shape
+        if self.col is None:  # im2col以外で計算した場合
+            self.col = self.im2col(self.x, FH, FW, self.stride, self.pad, role=id(self))
+            self.col_W = self.W.reshape(FN, -1).T
+        dout_col = _buffer(self, 'dout', (N*out_h*out_w, FN), dout.dtype)
+        dout_col.reshape(N, out_h, out_w, FN)[...] = dout.transpose(0,2,3,1)
+        dout = dout_col
+
+        self.db = np.sum(dout, axis=0, out=_grad_buffer(self, 'db', self.b.shape, self.b.dtype))
+        # (col.T・dout).Tを転置せずに直接求める
+        self.dW = _grad_buffer(self, 'dW', self.W.shape, self.W.dtype)
+        _dot(dout.T, self.col, self.dW.reshape(FN, -1))
+
+        dcol = np.dot(dout, self.col_W.T, out=_buffer(self, 'dcol', self.col.shape, np.result_type(dout, self.col_W)))
+        dx = self.col2im(dcol, self.x.shape, FH, FW, self.stride, self.pad, role=id(self))
 
         return dx
 
 
 class Pooling:
-    def __init__(self, pool_h, pool_w, stride=2, pad=0):
+    """
+    vectorized : Trueの場合はim2col_strided、col2im_vectorizedを使う
+    """
+    def __init__(self, pool_h, pool_w, stride=2, pad=0, vectorized=False):
         self.pool_h = pool_h
         self.pool_w = pool_w
         self.stride = stride
         self.pad = pad
+        self.vectorized = vectorized
+        self.im2col = im2col_strided if vectorized else im2col
+        self.col2im = col2im_vectorized if vectorized else col2im
         
         self.x = None
         self.arg_max = None
+        self.mask = None  # 重ならないプーリングの場合に使用
 
     def forward(self, x):
+        if self._is_non_overlapping():
+            return self._forward_non_overlapping(x)
+
         N, C, H, W = x.shape
         out_h = int(1 + (H - self.pool_h) / self.stride)
         out_w = int(1 + (W - self.pool_w) / self.stride)
 
-        col = im2col(x, self.pool_h, self.pool_w, self.stride, self.pad)
+        col = self.im2col(x, self.pool_h, self.pool_w, self.stride, self.pad, role=id(self))
         col = col.reshape(-1, self.pool_h*self.pool_w)
 
-        arg_max = np.argmax(col, axis=1)
-        out = np.max(col, axis=1)
+        out = np.max(col, axis=1, out=_buffer(self, 'out', col.shape[:1], col.dtype))
         out = out.reshape(N, out_h, out_w, C).transpose(0, 3, 1, 2)
 
-        self.x = x
-        self.arg_max = arg_max
+        if config.enable_backprop:
+            self.x = x
+            self.arg_max = np.argmax(col, axis=1, out=_buffer(self, 'arg_max', col.shape[:1], np.intp))
 
         return out
 
     def backward(self, dout):
+        if self._is_non_overlapping():
+            return self._backward_non_overlapping(dout)
+
         dout = dout.transpose(0, 2, 3, 1)
         
         pool_size = self.pool_h * self.pool_w
-        dmax = np.zeros((dout.size, pool_size))
+        dmax = _buffer(self, 'dmax', (dout.size, pool_size), dout.dtype)
+        dmax.fill(0)
         dmax[np.arange(self.arg_max.size), self.arg_max.flatten()] = dout.flatten()
         dmax = dmax.reshape(dout.shape + (pool_size,)) 
         
         dcol = dmax.reshape(dmax.shape[0] * dmax.shape[1] * dmax.shape[2], -1)
-        dx = col2im(dcol, self.x.shape, self.pool_h, self.pool_w, self.stride, self.pad)
+        dx = self.col2im(dcol, self.x.shape, self.pool_h, self.pool_w, self.stride, self.pad, role=id(self))
         
         return dx
+
+    def _is_non_overlapping(self):
+        return self.stride == self.pool_h == self.pool_w and self.pad == 0
+
+    def _forward_non_overlapping(self, x):
+        """im2colを使わず、(N, C, out_h, p, out_w, p)に並べ替えて最大値を取る"""
+        N, C, H, W = x.shape
+        p = self.stride
+        out_h, out_w = H // p, W // p
+
+        x_r = x[:, :, :out_h*p, :out_w*p].reshape(N, C, out_h, p, out_w, p)
+        out = _buffer(self, 'out', (N, C, out_h, out_w), x.dtype)
+        out[...] = x_r[:, :, :, 0, :, 0]
+        for i in range(p):  # max(axis=(3, 5))より窓内の位置ごとにmaximumを取る方が速い
+            for j in range(p):
+                np.maximum(out, x_r[:, :, :, i, :, j], out=out)
+
+        if not config.enable_backprop:
+            return out
+
+        # 最大値の位置を記録する（同じ値が複数ある場合はargmaxと同じく最初の位置のみ）
+        mask = _buffer(self, 'mask', x_r.shape, bool)
+        remaining = _buffer(self, 'remaining', out.shape, bool)
+        hit = _buffer(self, 'hit', out.shape, bool)
+        remaining.fill(True)
+        for i in range(p):
+            for j in range(p):
+                np.equal(x_r[:, :, :, i, :, j], out, out=hit)
+                hit &= remaining
+                mask[:, :, :, i, :, j] = hit
+                np.greater(remaining, hit, out=remaining)  # remaining & ~hit
+
+        self.x = x
+        self.mask = mask
+
+        return out
+
+    def _backward_non_overlapping(self, dout):
+        N, C, out_h, p, out_w, _ = self.mask.shape
+        dx = _buffer(self, 'dx', self.x.shape, dout.dtype)
+        dx_r = dx[:, :, :out_h*p, :out_w*p]
+        if dx_r.shape != dx.shape:  # 割り切れずに使われなかった端の部分
+            dx[:, :, out_h*p:, :] = 0
+            dx[:, :, :out_h*p, out_w*p:] = 0
+
+        # 軸を分けるだけなのでreshapeはコピーせずビューを返す
+        np.multiply(self.mask, dout[:, :, :, np.newaxis, :, np.newaxis],
+                    out=dx_r.reshape(N, C, out_h, p, out_w, p))
+
+        return dx
+
+
+class AffineRelu(Affine):
+    """Affine - ReLUを融合したレイヤ
+
+    行列積の出力にバイアスとReLUをその場で適用し、backward用のマスクは1つだけ保持する
+    """
+    def __init__(self, W, b):
+        super().__init__(W, b)
+        self.relu = Relu(inplace=True)
+
+    def forward(self, x):
+        return self.relu.forward(super().forward(x))
+
+    def backward(self, dout):
+        return super().backward(self.relu.backward(dout))
+
+
+class ConvolutionRelu(Convolution):
+    """Convolution - ReLUを融合したレイヤ"""
+    def __init__(self, W, b, stride=1, pad=0, vectorized=False, algo='im2col'):
+        super().__init__(W, b, stride, pad, vectorized, algo)
+        self.relu = Relu(inplace=True)
+
+    def forward(self, x):
+        return self.relu.forward(super().forward(x))
+
+    def backward(self, dout):
+        return super().backward(self.relu.backward(dout))
+
+
+def fuse_relu(layers):
+    """Affine、Convolutionの直後にあるReluを融合したレイヤに置き換える
+
+    Parameters
+    ----------
+    layers : レイヤのOrderedDictまたはlist
+        OrderedDictの場合、融合したレイヤには前側のレイヤのキーを使う
+
+    Returns
+    -------
+    置き換えたレイヤ（layersと同じ型）
+    """
+    is_dict = isinstance(layers, dict)
+    items = list(layers.items()) if is_dict else list(enumerate(layers))
+
+    fused = []
+    i = 0
+    while i < len(items):
+        key, layer = items[i]
+        next_layer = items[i+1][1] if i+1 < len(items) else None
+        if type(next_layer) is Relu and type(layer) is Affine:
+            layer, i = AffineRelu(layer.W, layer.b), i + 1
+        elif type(next_layer) is Relu and type(layer) is Convolution:
+            layer, i = ConvolutionRelu(layer.W, layer.b, layer.stride, layer.pad, layer.vectorized,
+                                       layer.algo), i + 1
+        fused.append((key, layer))
+        i += 1
+
+    if is_dict:
+        return type(layers)(fused)
+    return [layer for _, layer in fused]
+
+
+def fold_batchnorm(layers):
+    """推論用に、Affine、Convolutionの直後にあるBatch Normalizationを重みとバイアスに畳み込む
+
+    scale = gamma / sqrt(running_var + eps) とすると
+        W' = W * scale、 b' = (b - running_mean) * scale + beta
+    となり、BN（train_flg=False）の出力と同じになる。Convolutionの後は
+    チャンネルごとのSpatialBatchNormalizationだけを畳み込む。
+    元のレイヤのパラメータは書き換えず、畳み込んだ後にfuse_reluを適用する
+
+    Parameters
+    ----------
+    layers : レイヤのOrderedDictまたはlist
+        OrderedDictの場合、畳み込んだレイヤには前側のレイヤのキーを使う
+
+    Returns
+    -------
+    Batch Normalizationを除いたレイヤ（layersと同じ型）
+    """
+    is_dict = isinstance(layers, dict)
+    items = list(layers.items()) if is_dict else list(enumerate(layers))
+
+    folded = []
+    i = 0
+    while i < len(items):
+        key, layer = items[i]
+        next_layer = items[i+1][1] if i+1 < len(items) else None
+        if type(layer) is Affine and type(next_layer) is BatchNormalization:
+            scale, b = _fold_scale_bias(layer.b, next_layer)
+            layer, i = Affine((layer.W * scale).astype(layer.W.dtype, copy=False), b), i + 1
+        elif type(layer) is Convolution and type(next_layer) is SpatialBatchNormalization:
+            scale, b = _fold_scale_bias(layer.b, next_layer)
+            W = (layer.W * scale[:, np.newaxis, np.newaxis, np.newaxis]).astype(layer.W.dtype, copy=False)
+            layer, i = Convolution(W, b, layer.stride, layer.pad, layer.vectorized, layer.algo), i + 1
+        else:
+            # BN以外のレイヤも元のネットワークと状態（Dropoutの乱数生成器やバッファなど）を共有しないように
+            # 新しく作る。backward用に保持している中間データはコピーしない
+            cache = {id(val): None for name, val in vars(layer).items()
+                     if isinstance(val, np.ndarray) and name not in ('W', 'b')}
+            layer = copy.deepcopy(layer, cache)
+        folded.append((key, layer))
+        i += 1
+
+    if is_dict:
+        return fuse_relu(type(layers)(folded))
+    return fuse_relu([layer for _, layer in folded])
+
+
+def _fold_scale_bias(b, bn):
+    running_mean, running_var = bn.running_mean, bn.running_var
+    if running_mean is None:  # まだforwardしていない場合（BNと同じく0とみなす）
+        running_mean, running_var = np.zeros_like(bn.gamma), np.zeros_like(bn.gamma)
+    scale = bn.gamma / np.sqrt(running_var + 10e-7)
+    b = (b - running_mean) * scale + bn.beta
+    return scale, b.astype(bn.beta.dtype, copy=False)
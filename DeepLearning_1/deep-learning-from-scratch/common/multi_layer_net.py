@@ -1,10 +1,12 @@
 # coding: utf-8
 import sys, os
 sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
+import warnings
 import numpy as np
 from collections import OrderedDict
 from common.layers import *
 from common.gradient import numerical_gradient
+from common.util import flatten_params, flat_views
 
 
 class MultiLayerNet:
@@ -20,21 +22,38 @@ class MultiLayerNet:
         'relu'または'he'を指定した場合は「Heの初期値」を設定
         'sigmoid'または'xavier'を指定した場合は「Xavierの初期値」を設定
     weight_decay_lambda : Weight Decay（L2ノルム）の強さ
+        loss(with_weight_decay=True)で損失に加える項の計算にだけ使い、勾配には含めない。
+        重みの減衰はオプティマイザのweight_decayで行う（0以外を指定するとDeprecationWarningを出す）
+    dtype : パラメータのデータ型（e.g. np.float32）
     """
     def __init__(self, input_size, hidden_size_list, output_size,
-                 activation='relu', weight_init_std='relu', weight_decay_lambda=0):
+                 activation='relu', weight_init_std='relu', weight_decay_lambda=0, dtype=np.float64):
         self.input_size = input_size
         self.output_size = output_size
         self.hidden_size_list = hidden_size_list
         self.hidden_layer_num = len(hidden_size_list)
         self.weight_decay_lambda = weight_decay_lambda
+        if weight_decay_lambda != 0:
+            # 以前はgradient()で勾配にλWを加えていたため、そのつもりで渡すと正則化が効かなくなる
+            warnings.warn("weight_decay_lambda no longer adds the L2 term to the gradients; "
+                          "it is only used by loss(with_weight_decay=True). "
+                          "Pass weight_decay to the optimizer instead (e.g. SGD(lr, weight_decay=...))",
+                          DeprecationWarning, stacklevel=2)
+        self.dtype = dtype
         self.params = {}
 
         # 重みの初期化
         self.__init_weight(weight_init_std)
 
+        # パラメータと勾配はそれぞれ1つの連続したバッファのビューにする
+        # （オプティマイザはflat_params、flat_gradsをまとめて更新できる）
+        self.flat_params = flatten_params(self.params)
+        self.flat_grads = np.zeros_like(self.flat_params)
+        self.grads = flat_views(self.flat_grads, self.params)
+
         # レイヤの生成
-        activation_layer = {'sigmoid': Sigmoid, 'relu': Relu}
+        # Affineの出力は他で使わないので、ReLUは上書きしてよい
+        activation_layer = {'sigmoid': Sigmoid, 'relu': lambda: Relu(inplace=True)}
         self.layers = OrderedDict()
         for idx in range(1, self.hidden_layer_num+1):
             self.layers['Affine' + str(idx)] = Affine(self.params['W' + str(idx)],
@@ -44,6 +63,10 @@ class MultiLayerNet:
         idx = self.hidden_layer_num + 1
         self.layers['Affine' + str(idx)] = Affine(self.params['W' + str(idx)],
             self.params['b' + str(idx)])
+        self.layers = fuse_relu(self.layers)
+        for idx in range(1, self.hidden_layer_num+2):
+            layer = self.layers['Affine' + str(idx)]
+            layer.dW, layer.db = self.grads['W' + str(idx)], self.grads['b' + str(idx)]
 
         self.last_layer = SoftmaxWithLoss()
 
@@ -64,8 +87,8 @@ class MultiLayerNet:
             elif str(weight_init_std).lower() in ('sigmoid', 'xavier'):
                 scale = np.sqrt(1.0 / all_size_list[idx - 1])  # sigmoidを使う場合に推奨される初期値
 
-            self.params['W' + str(idx)] = scale * np.random.randn(all_size_list[idx-1], all_size_list[idx])
-            self.params['b' + str(idx)] = np.zeros(all_size_list[idx])
+            self.params['W' + str(idx)] = (scale * np.random.randn(all_size_list[idx-1], all_size_list[idx])).astype(self.dtype)
+            self.params['b' + str(idx)] = np.zeros(all_size_list[idx], dtype=self.dtype)
 
     def predict(self, x):
         for layer in self.layers.values():
@@ -73,29 +96,41 @@ class MultiLayerNet:
 
         return x
 
-    def loss(self, x, t):
+    def loss(self, x, t, with_weight_decay=False):
         """損失関数を求める
 
         Parameters
         ----------
         x : 入力データ
         t : 教師ラベル
+        with_weight_decay : Weight Decayの項を加えるかどうか（表示用）
 
         Returns
         -------
         損失関数の値
         """
         y = self.predict(x)
+        loss = self.last_layer.forward(y, t)
+        if with_weight_decay:
+            loss += self.weight_decay_loss()
+
+        return loss
+
+    def weight_decay_loss(self):
+        """Weight Decayの項 0.5 * λ * Σ||W||^2"""
+        if self.weight_decay_lambda == 0:
+            return 0
 
         weight_decay = 0
         for idx in range(1, self.hidden_layer_num + 2):
             W = self.params['W' + str(idx)]
-            weight_decay += 0.5 * self.weight_decay_lambda * np.sum(W ** 2)
+            weight_decay += 0.5 * self.weight_decay_lambda * np.dot(W.ravel(), W.ravel())
 
-        return self.last_layer.forward(y, t) + weight_decay
+        return weight_decay
 
     def accuracy(self, x, t):
-        y = self.predict(x)
+        with no_grad():
+            y = self.predict(x)
         y = np.argmax(y, axis=1)
         if t.ndim != 1 : t = np.argmax(t, axis=1)
 
@@ -139,8 +174,8 @@ class MultiLayerNet:
             grads['W1']、grads['W2']、...は各層の重み
             grads['b1']、grads['b2']、...は各層のバイアス
         """
-        # forward
-        self.loss(x, t)
+        # forward（損失はlast_lossに保持し、もう一度forwardしなくて済むようにする）
+        self.last_loss = self.loss(x, t)
 
         # backward
         dout = 1
@@ -154,7 +189,7 @@ class MultiLayerNet:
         # 設定
         grads = {}
         for idx in range(1, self.hidden_layer_num+2):
-            grads['W' + str(idx)] = self.layers['Affine' + str(idx)].dW + self.weight_decay_lambda * self.layers['Affine' + str(idx)].W
+            grads['W' + str(idx)] = self.layers['Affine' + str(idx)].dW
             grads['b' + str(idx)] = self.layers['Affine' + str(idx)].db
 
         return grads
@@ -1,10 +1,13 @@
 # coding: utf-8
 import sys, os
 sys.path.append(os.pardir) # 親ディレクトリのファイルをインポートするための設定
+import copy
+import warnings
 import numpy as np
 from collections import OrderedDict
 from common.layers import *
 from common.gradient import numerical_gradient
+from common.util import flatten_params, flat_views
 
 class MultiLayerNetExtend:
     """拡張版の全結合による多層ニューラルネットワーク
@@ -21,34 +24,50 @@ class MultiLayerNetExtend:
         'relu'または'he'を指定した場合は「Heの初期値」を設定
         'sigmoid'または'xavier'を指定した場合は「Xavierの初期値」を設定
     weight_decay_lambda : Weight Decay（L2ノルム）の強さ
+        loss(with_weight_decay=True)で損失に加える項の計算にだけ使い、勾配には含めない。
+        重みの減衰はオプティマイザのweight_decayで行う（0以外を指定するとDeprecationWarningを出す）
     use_dropout: Dropoutを使用するかどうか
     dropout_ration : Dropoutの割り合い
     use_batchNorm: Batch Normalizationを使用するかどうか
+    dtype : パラメータのデータ型（e.g. np.float32）
     """
     def __init__(self, input_size, hidden_size_list, output_size,
                  activation='relu', weight_init_std='relu', weight_decay_lambda=0, 
-                 use_dropout = False, dropout_ration = 0.5, use_batchnorm=False):
+                 use_dropout = False, dropout_ration = 0.5, use_batchnorm=False,
+                 dtype=np.float64):
         self.input_size = input_size
         self.output_size = output_size
         self.hidden_size_list = hidden_size_list
         self.hidden_layer_num = len(hidden_size_list)
         self.use_dropout = use_dropout
         self.weight_decay_lambda = weight_decay_lambda
+        if weight_decay_lambda != 0:
+            # 以前はgradient()で勾配にλWを加えていたため、そのつもりで渡すと正則化が効かなくなる
+            warnings.warn("weight_decay_lambda no longer adds the L2 term to the gradients; "
+                          "it is only used by loss(with_weight_decay=True). "
+                          "Pass weight_decay to the optimizer instead (e.g. SGD(lr, weight_decay=...))",
+                          DeprecationWarning, stacklevel=2)
+        self.dtype = dtype
         self.use_batchnorm = use_batchnorm
         self.params = {}
 
         # 重みの初期化
         self.__init_weight(weight_init_std)
 
+        # パラメータと勾配はそれぞれ1つの連続したバッファのビューにする
+        # （オプティマイザはflat_params、flat_gradsをまとめて更新できる）
+        self.flat_params = flatten_params(self.params)
+        self.flat_grads = np.zeros_like(self.flat_params)
+        self.grads = flat_views(self.flat_grads, self.params)
+
         # レイヤの生成
-        activation_layer = {'sigmoid': Sigmoid, 'relu': Relu}
+        # Affine（BatchNorm）の出力は他で使わないので、ReLUは上書きしてよい
+        activation_layer = {'sigmoid': Sigmoid, 'relu': lambda: Relu(inplace=True)}
         self.layers = OrderedDict()
         for idx in range(1, self.hidden_layer_num+1):
             self.layers['Affine' + str(idx)] = Affine(self.params['W' + str(idx)],
                                                       self.params['b' + str(idx)])
             if self.use_batchnorm:
-                self.params['gamma' + str(idx)] = np.ones(hidden_size_list[idx-1])
-                self.params['beta' + str(idx)] = np.zeros(hidden_size_list[idx-1])
                 self.layers['BatchNorm' + str(idx)] = BatchNormalization(self.params['gamma' + str(idx)], self.params['beta' + str(idx)])
                 
             self.layers['Activation_function' + str(idx)] = activation_layer[activation]()
@@ -58,6 +77,13 @@ class MultiLayerNetExtend:
 
         idx = self.hidden_layer_num + 1
         self.layers['Affine' + str(idx)] = Affine(self.params['W' + str(idx)], self.params['b' + str(idx)])
+        self.layers = fuse_relu(self.layers)
+        for idx in range(1, self.hidden_layer_num+2):
+            layer = self.layers['Affine' + str(idx)]
+            layer.dW, layer.db = self.grads['W' + str(idx)], self.grads['b' + str(idx)]
+            if self.use_batchnorm and idx != self.hidden_layer_num+1:
+                layer = self.layers['BatchNorm' + str(idx)]
+                layer.dgamma, layer.dbeta = self.grads['gamma' + str(idx)], self.grads['beta' + str(idx)]
 
         self.last_layer = SoftmaxWithLoss()
 
@@ -77,8 +103,11 @@ class MultiLayerNetExtend:
                 scale = np.sqrt(2.0 / all_size_list[idx - 1])  # ReLUを使う場合に推奨される初期値
             elif str(weight_init_std).lower() in ('sigmoid', 'xavier'):
                 scale = np.sqrt(1.0 / all_size_list[idx - 1])  # sigmoidを使う場合に推奨される初期値
-            self.params['W' + str(idx)] = scale * np.random.randn(all_size_list[idx-1], all_size_list[idx])
-            self.params['b' + str(idx)] = np.zeros(all_size_list[idx])
+            self.params['W' + str(idx)] = (scale * np.random.randn(all_size_list[idx-1], all_size_list[idx])).astype(self.dtype)
+            self.params['b' + str(idx)] = np.zeros(all_size_list[idx], dtype=self.dtype)
+            if self.use_batchnorm and idx != len(all_size_list) - 1:
+                self.params['gamma' + str(idx)] = np.ones(all_size_list[idx], dtype=self.dtype)
+                self.params['beta' + str(idx)] = np.zeros(all_size_list[idx], dtype=self.dtype)
 
     def predict(self, x, train_flg=False):
         for key, layer in self.layers.items():
@@ -89,27 +118,64 @@ class MultiLayerNetExtend:
 
         return x
 
-    def loss(self, x, t, train_flg=False):
+    def loss(self, x, t, train_flg=False, with_weight_decay=False):
         """損失関数を求める
         引数のxは入力データ、tは教師ラベル
+        with_weight_decayがTrueの場合はWeight Decayの項を加える（表示用）
         """
         y = self.predict(x, train_flg)
+        loss = self.last_layer.forward(y, t)
+        if with_weight_decay:
+            loss += self.weight_decay_loss()
+
+        return loss
+
+    def weight_decay_loss(self):
+        """Weight Decayの項 0.5 * λ * Σ||W||^2"""
+        if self.weight_decay_lambda == 0:
+            return 0
 
         weight_decay = 0
         for idx in range(1, self.hidden_layer_num + 2):
             W = self.params['W' + str(idx)]
-            weight_decay += 0.5 * self.weight_decay_lambda * np.sum(W**2)
+            weight_decay += 0.5 * self.weight_decay_lambda * np.dot(W.ravel(), W.ravel())
 
-        return self.last_layer.forward(y, t) + weight_decay
+        return weight_decay
 
     def accuracy(self, x, t):
-        y = self.predict(x, train_flg=False)
+        with no_grad():
+            y = self.predict(x, train_flg=False)
         y = np.argmax(y, axis=1)
         if t.ndim != 1 : t = np.argmax(t, axis=1)
 
         accuracy = np.sum(y == t) / float(x.shape[0])
         return accuracy
 
+    def fold_batchnorm(self):
+        """Batch Normalizationを直前のAffineの重みとバイアスに畳み込んだ推論用のネットワークを返す
+
+        running_mean、running_varを使うため、predict(train_flg=False)の出力は元のネットワークと同じになる
+        （誤差は丸め誤差の範囲）。元のネットワークのパラメータは変更しない
+        """
+        net = copy.copy(self)
+        net.use_batchnorm = False
+        net.layers = fold_batchnorm(self.layers)
+
+        net.params = {}
+        for idx in range(1, self.hidden_layer_num+2):
+            layer = net.layers['Affine' + str(idx)]
+            net.params['W' + str(idx)], net.params['b' + str(idx)] = layer.W, layer.b
+        net.flat_params = flatten_params(net.params)
+        net.flat_grads = np.zeros_like(net.flat_params)
+        net.grads = flat_views(net.flat_grads, net.params)
+        for idx in range(1, self.hidden_layer_num+2):
+            layer = net.layers['Affine' + str(idx)]
+            layer.W, layer.b = net.params['W' + str(idx)], net.params['b' + str(idx)]
+            layer.dW, layer.db = net.grads['W' + str(idx)], net.grads['b' + str(idx)]
+        net.last_layer = SoftmaxWithLoss()
+
+        return net
+
     def numerical_gradient(self, x, t):
         """勾配を求める（数値微分）
 
@@ -138,8 +204,8 @@ class MultiLayerNetExtend:
         return grads
         
     def gradient(self, x, t):
-        # forward
-        self.loss(x, t, train_flg=True)
+        # forward（損失はlast_lossに保持し、もう一度forwardしなくて済むようにする）
+        self.last_loss = self.loss(x, t, train_flg=True)
 
         # backward
         dout = 1
@@ -153,7 +219,7 @@ class MultiLayerNetExtend:
         # 設定
         grads = {}
         for idx in range(1, self.hidden_layer_num+2):
-            grads['W' + str(idx)] = self.layers['Affine' + str(idx)].dW + self.weight_decay_lambda * self.params['W' + str(idx)]
+            grads['W' + str(idx)] = self.layers['Affine' + str(idx)].dW
             grads['b' + str(idx)] = self.layers['Affine' + str(idx)].db
 
             if self.use_batchnorm and idx != self.hidden_layer_num+1:
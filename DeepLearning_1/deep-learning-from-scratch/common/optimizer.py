@@ -1,26 +1,65 @@
 # coding: utf-8
 import numpy as np
 
+
+def _scratch(bufs, key, like):
+    """keyごとの作業用の配列（まだ無いか、形状・データ型が変わった場合は確保し直す）"""
+    buf = bufs.get(key)
+    if buf is None or buf.shape != like.shape or buf.dtype != like.dtype:
+        buf = bufs[key] = np.empty_like(like)
+    return buf
+
+
+def _is_weight(key):
+    """Weight Decayの対象か（重みのキーは'W'で始まる。バイアスやBatchNormのパラメータは対象外）"""
+    return key.startswith('W')
+
+
+def _l2_grad(key, param, grad, weight_decay, bufs):
+    """L2正則化の項を加えた勾配 grad + weight_decay * param を求める（重み以外はgradのまま）
+
+    結果を書き込む配列はbufsからkeyごとに取り出すため、weight_decay=0の場合は確保しない
+    """
+    if weight_decay == 0 or not _is_weight(key):
+        return grad
+    out = _scratch(bufs, key, param)
+    np.multiply(param, weight_decay, out=out)
+    out += grad
+    return out
+
+
 class SGD:
 
-    """確率的勾配降下法（Stochastic Gradient Descent）"""
+    """確率的勾配降下法（Stochastic Gradient Descent）
 
-    def __init__(self, lr=0.01):
+    weight_decay : L2正則化の強さ（重みの勾配にweight_decay * Wを加える）
+    """
+
+    def __init__(self, lr=0.01, weight_decay=0):
         self.lr = lr
+        self.weight_decay = weight_decay
+        self.buf = {}  # 一時配列を作らずに済ませるための作業領域（キーごとに必要になった時に確保する）
         
     def update(self, params, grads):
         for key in params.keys():
-            params[key] -= self.lr * grads[key] 
+            #params[key] -= self.lr * (grads[key] + self.weight_decay * params[key])
+            buf = _scratch(self.buf, key, params[key])
+            grad = _l2_grad(key, params[key], grads[key], self.weight_decay, self.buf)
+            np.multiply(grad, self.lr, out=buf)
+            params[key] -= buf
 
 
 class Momentum:
 
     """Momentum SGD"""
 
-    def __init__(self, lr=0.01, momentum=0.9):
+    def __init__(self, lr=0.01, momentum=0.9, weight_decay=0):
         self.lr = lr
         self.momentum = momentum
+        self.weight_decay = weight_decay
         self.v = None
+        self.buf = {}
+        self.grad_buf = {}  # L2正則化の項を加えた勾配（weight_decayが0でなければ確保する）
         
     def update(self, params, grads):
         if self.v is None:
@@ -29,7 +68,13 @@ class Momentum:
                 self.v[key] = np.zeros_like(val)
                 
         for key in params.keys():
-            self.v[key] = self.momentum*self.v[key] - self.lr*grads[key] 
+            grad = _l2_grad(key, params[key], grads[key], self.weight_decay, self.grad_buf)
+            #self.v[key] = self.momentum*self.v[key] - self.lr*grads[key]
+            #params[key] += self.v[key]
+            self.v[key] *= self.momentum
+            buf = _scratch(self.buf, key, params[key])
+            np.multiply(grad, self.lr, out=buf)
+            self.v[key] -= buf
             params[key] += self.v[key]
 
 
@@ -37,10 +82,13 @@ class Nesterov:
 
     """Nesterov's Accelerated Gradient (http://arxiv.org/abs/1212.0901)"""
 
-    def __init__(self, lr=0.01, momentum=0.9):
+    def __init__(self, lr=0.01, momentum=0.9, weight_decay=0):
         self.lr = lr
         self.momentum = momentum
+        self.weight_decay = weight_decay
         self.v = None
+        self.buf = {}
+        self.grad_buf = {}
         
     def update(self, params, grads):
         if self.v is None:
@@ -49,19 +97,31 @@ class Nesterov:
                 self.v[key] = np.zeros_like(val)
             
         for key in params.keys():
-            params[key] += self.momentum * self.momentum * self.v[key]
-            params[key] -= (1 + self.momentum) * self.lr * grads[key]
+            grad = _l2_grad(key, params[key], grads[key], self.weight_decay, self.grad_buf)
+            #params[key] += self.momentum * self.momentum * self.v[key]
+            #params[key] -= (1 + self.momentum) * self.lr * grads[key]
+            #self.v[key] *= self.momentum
+            #self.v[key] -= self.lr * grads[key]
+            buf = _scratch(self.buf, key, params[key])
+            np.multiply(self.v[key], self.momentum * self.momentum, out=buf)
+            params[key] += buf
+            np.multiply(grad, (1 + self.momentum) * self.lr, out=buf)
+            params[key] -= buf
             self.v[key] *= self.momentum
-            self.v[key] -= self.lr * grads[key]
+            np.multiply(grad, self.lr, out=buf)
+            self.v[key] -= buf
 
 
 class AdaGrad:
 
     """AdaGrad"""
 
-    def __init__(self, lr=0.01):
+    def __init__(self, lr=0.01, weight_decay=0):
         self.lr = lr
+        self.weight_decay = weight_decay
         self.h = None
+        self.buf = {}
+        self.grad_buf = {}
         
     def update(self, params, grads):
         if self.h is None:
@@ -70,18 +130,30 @@ class AdaGrad:
                 self.h[key] = np.zeros_like(val)
             
         for key in params.keys():
-            self.h[key] += grads[key] * grads[key]
-            params[key] -= self.lr * grads[key] / (np.sqrt(self.h[key]) + 1e-7)
+            grad = _l2_grad(key, params[key], grads[key], self.weight_decay, self.grad_buf)
+            #self.h[key] += grads[key] * grads[key]
+            #params[key] -= self.lr * grads[key] / (np.sqrt(self.h[key]) + 1e-7)
+            buf = _scratch(self.buf, key, params[key])
+            np.multiply(grad, grad, out=buf)
+            self.h[key] += buf
+            np.sqrt(self.h[key], out=buf)
+            buf += 1e-7
+            np.divide(grad, buf, out=buf)
+            buf *= self.lr
+            params[key] -= buf
 
 
 class RMSprop:
 
     """RMSprop"""
 
-    def __init__(self, lr=0.01, decay_rate = 0.99):
+    def __init__(self, lr=0.01, decay_rate = 0.99, weight_decay=0):
         self.lr = lr
         self.decay_rate = decay_rate
+        self.weight_decay = weight_decay
         self.h = None
+        self.buf = {}
+        self.grad_buf = {}
         
     def update(self, params, grads):
         if self.h is None:
@@ -90,22 +162,41 @@ class RMSprop:
                 self.h[key] = np.zeros_like(val)
             
         for key in params.keys():
+            grad = _l2_grad(key, params[key], grads[key], self.weight_decay, self.grad_buf)
+            #self.h[key] *= self.decay_rate
+            #self.h[key] += (1 - self.decay_rate) * grads[key] * grads[key]
+            #params[key] -= self.lr * grads[key] / (np.sqrt(self.h[key]) + 1e-7)
+            buf = _scratch(self.buf, key, params[key])
             self.h[key] *= self.decay_rate
-            self.h[key] += (1 - self.decay_rate) * grads[key] * grads[key]
-            params[key] -= self.lr * grads[key] / (np.sqrt(self.h[key]) + 1e-7)
+            np.multiply(grad, grad, out=buf)
+            buf *= 1 - self.decay_rate
+            self.h[key] += buf
+            np.sqrt(self.h[key], out=buf)
+            buf += 1e-7
+            np.divide(grad, buf, out=buf)
+            buf *= self.lr
+            params[key] -= buf
 
 
 class Adam:
 
-    """Adam (http://arxiv.org/abs/1412.6980v8)"""
+    """Adam (http://arxiv.org/abs/1412.6980v8)
 
-    def __init__(self, lr=0.001, beta1=0.9, beta2=0.999):
+    weight_decay : L2正則化の強さ（重みの勾配にweight_decay * Wを加える）
+    """
+
+    decoupled = False  # Trueの場合、重みの減衰を勾配に含めずに直接行う（AdamW）
+
+    def __init__(self, lr=0.001, beta1=0.9, beta2=0.999, weight_decay=0):
         self.lr = lr
         self.beta1 = beta1
         self.beta2 = beta2
+        self.weight_decay = weight_decay
         self.iter = 0
         self.m = None
         self.v = None
+        self.buf = {}
+        self.grad_buf = {}
         
     def update(self, params, grads):
         if self.m is None:
@@ -115,16 +206,49 @@ class Adam:
                 self.v[key] = np.zeros_like(val)
         
         self.iter += 1
-        lr_t  = self.lr * np.sqrt(1.0 - self.beta2**self.iter) / (1.0 - self.beta1**self.iter)         
+        # Pythonのfloatにしておき、float32のパラメータがfloat64に昇格しないようにする
+        lr_t  = self.lr * (1.0 - self.beta2**self.iter)**0.5 / (1.0 - self.beta1**self.iter)
         
         for key in params.keys():
+            if self.decoupled:
+                grad = grads[key]
+                if self.weight_decay != 0 and _is_weight(key):
+                    params[key] *= 1 - self.lr * self.weight_decay
+            else:
+                grad = _l2_grad(key, params[key], grads[key], self.weight_decay, self.grad_buf)
             #self.m[key] = self.beta1*self.m[key] + (1-self.beta1)*grads[key]
             #self.v[key] = self.beta2*self.v[key] + (1-self.beta2)*(grads[key]**2)
-            self.m[key] += (1 - self.beta1) * (grads[key] - self.m[key])
-            self.v[key] += (1 - self.beta2) * (grads[key]**2 - self.v[key])
-            
-            params[key] -= lr_t * self.m[key] / (np.sqrt(self.v[key]) + 1e-7)
+            #self.m[key] += (1 - self.beta1) * (grads[key] - self.m[key])
+            #self.v[key] += (1 - self.beta2) * (grads[key]**2 - self.v[key])
+            #params[key] -= lr_t * self.m[key] / (np.sqrt(self.v[key]) + 1e-7)
+            buf = _scratch(self.buf, key, params[key])
+            np.subtract(grad, self.m[key], out=buf)
+            buf *= 1 - self.beta1
+            self.m[key] += buf
+            np.multiply(grad, grad, out=buf)
+            buf -= self.v[key]
+            buf *= 1 - self.beta2
+            self.v[key] += buf
+
+            np.sqrt(self.v[key], out=buf)
+            buf += 1e-7
+            np.divide(self.m[key], buf, out=buf)
+            buf *= lr_t
+            params[key] -= buf
             
             #unbias_m += (1 - self.beta1) * (grads[key] - self.m[key]) # correct bias
             #unbisa_b += (1 - self.beta2) * (grads[key]*grads[key] - self.v[key]) # correct bias
             #params[key] += self.lr * unbias_m / (np.sqrt(unbisa_b) + 1e-7)
+
+
+class AdamW(Adam):
+
+    """重みの減衰をAdamの更新から切り離したAdam (http://arxiv.org/abs/1711.05101)
+
+    重みは勾配とは別に、毎回 W *= 1 - lr * weight_decay で減衰させる
+    """
+
+    decoupled = True
+
+    def __init__(self, lr=0.001, beta1=0.9, beta2=0.999, weight_decay=0.01):
+        super().__init__(lr, beta1, beta2, weight_decay)
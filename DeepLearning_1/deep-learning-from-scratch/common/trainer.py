@@ -1,16 +1,78 @@
 # coding: utf-8
 import sys, os
 sys.path.append(os.pardir)  # 親ディレクトリのファイルをインポートするための設定
+import copy
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from common.optimizer import *
+from common.data_loader import DataLoader
+from common.layers import no_grad
+from common.buffer_pool import BufferPool, using_buffer_pool
+from common.util import flat_groups
+
+
+def chunked_accuracy(network, x, t, batch_size=1000):
+    """データをbatch_sizeずつに分けて認識精度を求める
+
+    推論モード（no_grad）で実行するため各層は中間データを保持せず、
+    ピークメモリはbatch_size分の出力だけで済む
+    """
+    if t.ndim != 1 : t = np.argmax(t, axis=1)
+
+    acc = 0
+    for i in range(0, x.shape[0], batch_size):
+        with no_grad():
+            y = network.predict(x[i:i+batch_size])
+        acc += np.sum(np.argmax(y, axis=1) == t[i:i+batch_size])
+
+    return acc / x.shape[0]
+
+
+# 評価用のコピーに含めるレイヤの配列（パラメータと推論に使う移動平均）
+_EVALUATION_ARRAYS = ('W', 'b', 'gamma', 'beta', 'running_mean', 'running_var')
+
+
+def evaluation_copy(network):
+    """推論に必要なものだけを持つネットワークのコピー
+
+    各レイヤがbackward用に保持している中間データ（Convolutionのcolや入力、マスク、勾配など）は
+    コピーせずNoneにするため、コピーの大きさはほぼパラメータの分だけになる
+    """
+    memo = {}
+    layers = network.layers.values() if isinstance(network.layers, dict) else network.layers
+    stack = list(layers) + [getattr(network, 'last_layer', None)]
+    while stack:
+        layer = stack.pop()
+        for name, val in getattr(layer, '__dict__', {}).items():
+            if isinstance(val, np.ndarray):
+                if name not in _EVALUATION_ARRAYS:
+                    memo[id(val)] = None
+            elif hasattr(val, 'forward'):  # AffineReluのreluなど、レイヤが持つレイヤ
+                stack.append(val)
+    flat_grads = getattr(network, 'flat_grads', None)
+    if flat_grads is not None:
+        memo[id(flat_grads)] = None
+
+    return copy.deepcopy(network, memo)
+
 
 class Trainer:
     """ニューラルネットの訓練を行うクラス
+
+    use_data_loaderがTrueの場合は、復元抽出の代わりにDataLoaderで
+    エポックごとにシャッフルしたミニバッチを別スレッドで用意する。
+    エポックごとの認識精度はevaluate_batch_sizeずつに分けて求め、
+    evaluate_asyncがTrueの場合はネットワークのコピーを使って別スレッドで求める
+    （その間も訓練は続く）。
+    use_buffer_poolがTrueの場合は、各レイヤの出力や勾配の配列をステップ間で使い回す
+    （buffer_pool.missesでプールに無く新しく確保した回数を確認できる）
     """
     def __init__(self, network, x_train, t_train, x_test, t_test,
                  epochs=20, mini_batch_size=100,
                  optimizer='SGD', optimizer_param={'lr':0.01}, 
-                 evaluate_sample_num_per_epoch=None, verbose=True):
+                 evaluate_sample_num_per_epoch=None, verbose=True,
+                 use_data_loader=False, evaluate_batch_size=1000, evaluate_async=False,
+                 use_buffer_pool=False):
         self.network = network
         self.verbose = verbose
         self.x_train = x_train
@@ -20,10 +82,26 @@ class Trainer:
         self.epochs = epochs
         self.batch_size = mini_batch_size
         self.evaluate_sample_num_per_epoch = evaluate_sample_num_per_epoch
+        self.evaluate_batch_size = evaluate_batch_size
+
+        self.executor = None
+        self.pending_evaluations = []
+        if evaluate_async:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.buffer_pool = BufferPool() if use_buffer_pool else None
+
+        self.data_loader = None
+        self.batch_iter = None
+        if use_data_loader:
+            # 訓練データがmini_batch_sizeより少ない場合は、1つのミニバッチも作れなくならないように
+            # 最後の（唯一の）ミニバッチを捨てない
+            self.data_loader = DataLoader(x_train, t_train, mini_batch_size, shuffle=True,
+                                          drop_last=x_train.shape[0] >= mini_batch_size)
 
         # optimizer
         optimizer_class_dict = {'sgd':SGD, 'momentum':Momentum, 'nesterov':Nesterov,
-                                'adagrad':AdaGrad, 'rmsprop':RMSprop, 'adam':Adam}
+                                'adagrad':AdaGrad, 'rmsprop':RMSprop, 'adam':Adam, 'adamw':AdamW}
         self.optimizer = optimizer_class_dict[optimizer.lower()](**optimizer_param)
         
         self.train_size = x_train.shape[0]
@@ -36,15 +114,36 @@ class Trainer:
         self.train_acc_list = []
         self.test_acc_list = []
 
+    def next_batch(self):
+        if self.data_loader is None:
+            batch_mask = np.random.choice(self.train_size, self.batch_size)
+            return self.x_train[batch_mask], self.t_train[batch_mask]
+
+        batch = None
+        if self.batch_iter is not None:
+            batch = next(self.batch_iter, None)
+        if batch is None:  # エポックの終わり
+            self.batch_iter = iter(self.data_loader)
+            batch = next(self.batch_iter)
+        return batch
+
     def train_step(self):
-        batch_mask = np.random.choice(self.train_size, self.batch_size)
-        x_batch = self.x_train[batch_mask]
-        t_batch = self.t_train[batch_mask]
-        
-        grads = self.network.gradient(x_batch, t_batch)
-        self.optimizer.update(self.network.params, grads)
+        x_batch, t_batch = self.next_batch()
         
-        loss = self.network.loss(x_batch, t_batch)
+        with using_buffer_pool(self.buffer_pool):
+            grads = self.network.gradient(x_batch, t_batch)
+        # 更新前のパラメータでgradientが計算した損失を使う
+        loss = getattr(self.network, 'last_loss', None)
+        if hasattr(self.network, 'flat_params'):
+            # パラメータと勾配はそれぞれ1つのバッファのビューなので、まとめて一度に更新する
+            # （Weight Decayは重みの部分だけにかける）
+            self.optimizer.update(flat_groups(self.network.flat_params, self.network.params),
+                                  flat_groups(self.network.flat_grads, self.network.params))
+        else:
+            self.optimizer.update(self.network.params, grads)
+
+        if loss is None:
+            loss = self.network.loss(x_batch, t_batch)
         self.train_loss_list.append(loss)
         if self.verbose: print("train loss:" + str(loss))
         
@@ -57,20 +156,50 @@ class Trainer:
                 t = self.evaluate_sample_num_per_epoch
                 x_train_sample, t_train_sample = self.x_train[:t], self.t_train[:t]
                 x_test_sample, t_test_sample = self.x_test[:t], self.t_test[:t]
-                
-            train_acc = self.network.accuracy(x_train_sample, t_train_sample)
-            test_acc = self.network.accuracy(x_test_sample, t_test_sample)
-            self.train_acc_list.append(train_acc)
-            self.test_acc_list.append(test_acc)
 
-            if self.verbose: print("=== epoch:" + str(self.current_epoch) + ", train acc:" + str(train_acc) + ", test acc:" + str(test_acc) + " ===")
+            if self.executor is None:
+                self.record_accuracy(self.current_epoch,
+                                     *self.evaluate(self.network, x_train_sample, t_train_sample,
+                                                    x_test_sample, t_test_sample))
+            else:
+                # 訓練で更新されるパラメータと共有しないように、パラメータだけのコピーを評価する
+                network = evaluation_copy(self.network)
+                future = self.executor.submit(self.evaluate, network, x_train_sample, t_train_sample,
+                                              x_test_sample, t_test_sample)
+                self.pending_evaluations.append((self.current_epoch, future))
+
+        self.collect_evaluations()
         self.current_iter += 1
 
+    def evaluate(self, network, x_train_sample, t_train_sample, x_test_sample, t_test_sample):
+        train_acc = chunked_accuracy(network, x_train_sample, t_train_sample, self.evaluate_batch_size)
+        test_acc = chunked_accuracy(network, x_test_sample, t_test_sample, self.evaluate_batch_size)
+        return train_acc, test_acc
+
+    def record_accuracy(self, epoch, train_acc, test_acc):
+        self.train_acc_list.append(train_acc)
+        self.test_acc_list.append(test_acc)
+
+        if self.verbose: print("=== epoch:" + str(epoch) + ", train acc:" + str(train_acc) + ", test acc:" + str(test_acc) + " ===")
+
+    def collect_evaluations(self, wait=False):
+        """別スレッドでの評価が終わったものからエポック順に記録する"""
+        while self.pending_evaluations:
+            epoch, future = self.pending_evaluations[0]
+            if not wait and not future.done():
+                break
+            self.record_accuracy(epoch, *future.result())
+            self.pending_evaluations.pop(0)
+
     def train(self):
         for i in range(self.max_iter):
             self.train_step()
 
-        test_acc = self.network.accuracy(self.x_test, self.t_test)
+        if self.executor is not None:
+            self.collect_evaluations(wait=True)
+            self.executor.shutdown()
+
+        test_acc = chunked_accuracy(self.network, self.x_test, self.t_test, self.evaluate_batch_size)
 
         if self.verbose:
             print("=============== Final Test Accuracy ===============")
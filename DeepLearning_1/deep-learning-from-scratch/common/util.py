@@ -1,5 +1,7 @@
 # coding: utf-8
+from functools import lru_cache
 import numpy as np
+from common import buffer_pool
 
 
 def smooth_curve(x):
@@ -32,11 +34,80 @@ def shuffle_dataset(x, t):
 
     return x, t
 
+def flatten_params(params):
+    """paramsの各配列を1つの連続した1次元配列にまとめる
+
+    paramsの値は、まとめた配列を区切ったビューに置き換える。
+    オプティマイザはまとめた配列を一度に更新でき、ビューを参照するレイヤにもそのまま反映される。
+    重み（キーが'W'で始まるもの）を先に並べるため、flat_groupsで重みとそれ以外に分けられる
+
+    Parameters
+    ----------
+    params : パラメータのディクショナリ
+
+    Returns
+    -------
+    flat : すべてのパラメータを並べた1次元配列
+    """
+    dtype = np.result_type(*params.values())
+    flat = np.empty(sum(val.size for val in params.values()), dtype=dtype)
+    views = flat_views(flat, params)
+    for key, val in views.items():
+        val[...] = params[key]
+        params[key] = val
+
+    return flat
+
+
+def flat_views(flat, params):
+    """flatをparamsの各配列と同じ形状に区切ったビューのディクショナリ（勾配の格納先などに使う）"""
+    views = {}
+    offset = 0
+    for key in _flat_order(params):
+        val = params[key]
+        views[key] = flat[offset:offset + val.size].reshape(val.shape)
+        offset += val.size
+
+    return views
+
+
+def flat_groups(flat, params):
+    """flatを重み（'W'）とそれ以外（'other'）の2つのビューに分ける
+
+    オプティマイザに渡すと、重みだけにWeight Decayがかかる
+    """
+    weight_size = sum(val.size for key, val in params.items() if key.startswith('W'))
+    return {'W': flat[:weight_size], 'other': flat[weight_size:]}
+
+
+def _flat_order(params):
+    return sorted(params, key=lambda key: not key.startswith('W'))  # 安定ソートなので元の順序は保つ
+
+
 def conv_output_size(input_size, filter_size, stride=1, pad=0):
     return (input_size + 2*pad - filter_size) / stride + 1
 
 
-def im2col(input_data, filter_h, filter_w, stride=1, pad=0):
+def _role(role, name):
+    return None if role is None else (role, name)
+
+
+def _pad(input_data, pad, role=None):
+    """上下左右にpadだけ0を詰めた画像（roleを指定するとバッファプールから取り出す）"""
+    if pad == 0:
+        return input_data
+
+    N, C, H, W = input_data.shape
+    img = buffer_pool.empty((N, C, H + 2*pad, W + 2*pad), input_data.dtype, _role(role, 'pad'))
+    img[:, :, :pad, :] = 0
+    img[:, :, H + pad:, :] = 0
+    img[:, :, pad:H + pad, :pad] = 0
+    img[:, :, pad:H + pad, W + pad:] = 0
+    img[:, :, pad:H + pad, pad:W + pad] = input_data
+    return img
+
+
+def im2col(input_data, filter_h, filter_w, stride=1, pad=0, role=None):
     """
 
     Parameters
@@ -46,6 +117,8 @@ def im2col(input_data, filter_h, filter_w, stride=1, pad=0):
     filter_w : フィルターの幅
     stride : ストライド
     pad : パディング
+    role : 指定すると、結果と作業用の配列を有効なバッファプールから取り出す
+        （同じroleの結果は次の呼び出しで上書きされる）
 
     Returns
     -------
@@ -55,8 +128,8 @@ def im2col(input_data, filter_h, filter_w, stride=1, pad=0):
     out_h = (H + 2*pad - filter_h)//stride + 1
     out_w = (W + 2*pad - filter_w)//stride + 1
 
-    img = np.pad(input_data, [(0,0), (0,0), (pad, pad), (pad, pad)], 'constant')
-    col = np.zeros((N, C, filter_h, filter_w, out_h, out_w))
+    img = _pad(input_data, pad, role)
+    col = buffer_pool.empty((N, C, filter_h, filter_w, out_h, out_w), input_data.dtype, _role(role, 'col6'))
 
     for y in range(filter_h):
         y_max = y + stride*out_h
@@ -64,11 +137,158 @@ def im2col(input_data, filter_h, filter_w, stride=1, pad=0):
             x_max = x + stride*out_w
             col[:, :, y, x, :, :] = img[:, :, y:y_max:stride, x:x_max:stride]
 
-    col = col.transpose(0, 4, 5, 1, 2, 3).reshape(N*out_h*out_w, -1)
-    return col
+    out = buffer_pool.empty((N*out_h*out_w, C*filter_h*filter_w), input_data.dtype, _role(role, 'col'))
+    out.reshape(N, out_h, out_w, C, filter_h, filter_w)[...] = col.transpose(0, 4, 5, 1, 2, 3)
+    return out
+
+
+def im2col_strided(input_data, filter_h, filter_w, stride=1, pad=0, role=None):
+    """ストライドを操作したビューによるim2col
+
+    中間バッファを確保せず、(N, out_h, out_w, C, filter_h, filter_w)のビューを
+    as_stridedで作ってから一度だけコピーする。結果はim2colと同じ
+
+    Parameters
+    ----------
+    input_data : (データ数, チャンネル, 高さ, 幅)の4次元配列からなる入力データ
+    filter_h : フィルターの高さ
+    filter_w : フィルターの幅
+    stride : ストライド
+    pad : パディング
+    role : 指定すると、結果と作業用の配列を有効なバッファプールから取り出す
+
+    Returns
+    -------
+    col : 2次元配列
+    """
+    N, C, H, W = input_data.shape
+    out_h = (H + 2*pad - filter_h)//stride + 1
+    out_w = (W + 2*pad - filter_w)//stride + 1
+
+    img = _pad(input_data, pad, role)
+
+    sN, sC, sH, sW = img.strides
+    col = np.lib.stride_tricks.as_strided(
+        img, shape=(N, out_h, out_w, C, filter_h, filter_w),
+        strides=(sN, sH*stride, sW*stride, sC, sH, sW), writeable=False)
+
+    out = buffer_pool.empty((N*out_h*out_w, C*filter_h*filter_w), input_data.dtype, _role(role, 'col'))
+    out.reshape(col.shape)[...] = col
+    return out
+
+
+def _winograd_bt(d0, d1, d2, d3, out):
+    """B^T = [[1, 0, -1, 0], [0, 1, 1, 0], [0, -1, 1, 0], [0, 1, 0, -1]] を掛けた4つをoutに書き込む"""
+    np.subtract(d0, d2, out=out[0])
+    np.add(d1, d2, out=out[1])
+    np.subtract(d2, d1, out=out[2])
+    np.subtract(d1, d3, out=out[3])
+
+
+def winograd_conv(input_data, W, pad=0, role=None):
+    """Winograd F(2x2, 3x3)による畳み込み（3x3、ストライド1のフィルターのみ）
+
+    出力を2x2のタイルに分け、4x4の入力タイルとフィルターを変換してから要素ごとに掛ける。
+    1タイルあたりの乗算は36回から16回に減り、im2colのように入力を9倍に展開することもない。
+    チャンネル方向の和は変換後の16要素それぞれの行列積にまとめる
+
+    Parameters
+    ----------
+    input_data : (データ数, チャンネル, 高さ, 幅)の4次元配列からなる入力データ
+    W : (フィルター数, チャンネル, 3, 3)のフィルター
+    pad : パディング
+    role : 指定すると、結果と作業用の配列を有効なバッファプールから取り出す
+
+    Returns
+    -------
+    out : (データ数, 出力の高さ, 出力の幅, フィルター数)の4次元配列
+    """
+    FN, C, FH, FW = W.shape
+    N, C, H, W_ = input_data.shape
+    out_h, out_w = H + 2*pad - 2, W_ + 2*pad - 2
+    tile_h, tile_w = (out_h + 1)//2, (out_w + 1)//2
+    dtype = np.result_type(input_data, W)
+
+    # 2x2のタイルが収まるように右と下にも0を詰め、(N, 高さ, 幅, C)の並びにする
+    img = buffer_pool.zeros((N, 2*tile_h + 2, 2*tile_w + 2, C), dtype, _role(role, 'winograd_img'))
+    img[:, pad:H + pad, pad:W_ + pad, :] = input_data.transpose(0, 2, 3, 1)
+    sN, sH, sW, sC = img.strides
+    d = np.lib.stride_tricks.as_strided(
+        img, shape=(N, tile_h, tile_w, 4, 4, C),
+        strides=(sN, sH*2, sW*2, sH, sW, sC), writeable=False)
+
+    # 入力の変換 V = B^T d B
+    rows = buffer_pool.empty((4, N, tile_h, tile_w, 4, C), dtype, _role(role, 'winograd_rows'))
+    _winograd_bt(*(d[:, :, :, k] for k in range(4)), out=rows)
+    V = buffer_pool.empty((4, 4, N*tile_h*tile_w, C), dtype, _role(role, 'winograd_V'))
+    for i in range(4):
+        _winograd_bt(*(rows[i, :, :, :, k].reshape(-1, C) for k in range(4)), out=V[i])
+
+    # フィルターの変換 U = G g G^T
+    G = np.array([[1.0, 0.0, 0.0], [0.5, 0.5, 0.5], [0.5, -0.5, 0.5], [0.0, 0.0, 1.0]], dtype=dtype)
+    U = np.einsum('ik,fckl,jl->ijcf', G, W, G).reshape(16, C, FN)
+
+    M = buffer_pool.empty((16, N*tile_h*tile_w, FN), dtype, _role(role, 'winograd_M'))
+    np.matmul(V.reshape(16, -1, C), U, out=M)
+    M = M.reshape(4, 4, N, tile_h, tile_w, FN)
+
+    # 出力の変換 Y = A^T M A （A^T = [[1, 1, 1, 0], [0, 1, -1, -1]]）
+    S = buffer_pool.empty((2, 4, N, tile_h, tile_w, FN), dtype, _role(role, 'winograd_S'))
+    np.add(M[0], M[1], out=S[0])
+    S[0] += M[2]
+    np.subtract(M[1], M[2], out=S[1])
+    S[1] -= M[3]
+    Y = buffer_pool.empty((N, tile_h, tile_w, FN), dtype, _role(role, 'winograd_Y'))
+    out = buffer_pool.empty((N, out_h, out_w, FN), dtype, _role(role, 'winograd_out'))
+    for a in range(2):
+        np.add(S[a, 0], S[a, 1], out=Y)
+        Y += S[a, 2]
+        out[:, a::2, 0::2] = Y[:, :(out_h - a + 1)//2, :(out_w + 1)//2]
+        np.subtract(S[a, 1], S[a, 2], out=Y)
+        Y -= S[a, 3]
+        out[:, a::2, 1::2] = Y[:, :(out_h - a + 1)//2, :out_w//2]
+
+    return out
+
+
+def fft_conv(input_data, W, stride=1, pad=0, role=None):
+    """FFTによる畳み込み（im2colと同じく、フィルターを反転しない相関を求める）
+
+    計算量がフィルターの大きさにほとんど依存しないため、大きなフィルターに向く。
+    チャンネル方向の和は周波数ごとの(N, C)と(C, FN)の行列積にまとめる
+
+    Parameters
+    ----------
+    input_data : (データ数, チャンネル, 高さ, 幅)の4次元配列からなる入力データ
+    W : (フィルター数, チャンネル, 高さ, 幅)のフィルター
+    stride : ストライド
+    pad : パディング
+    role : 指定すると、結果を有効なバッファプールから取り出す
+
+    Returns
+    -------
+    out : (データ数, 出力の高さ, 出力の幅, フィルター数)の4次元配列
+    """
+    FN, C, FH, FW = W.shape
+    N, C, H, W_ = input_data.shape
+    out_h = (H + 2*pad - FH)//stride + 1
+    out_w = (W_ + 2*pad - FW)//stride + 1
+    size = (H + 2*pad, W_ + 2*pad)
+
+    img = _pad(input_data, pad, role)
+    X = np.fft.rfft2(img, s=size).reshape(N, C, -1)
+    K = np.fft.rfft2(W[:, :, ::-1, ::-1], s=size).reshape(FN, C, -1)
+    Y = np.matmul(X.transpose(2, 0, 1), K.transpose(2, 1, 0))  # (周波数, N, FN)
+    y = np.fft.irfft2(Y.transpose(1, 2, 0).reshape(N, FN, size[0], -1), s=size)
+
+    # 巡回畳み込みの折り返しを含まない部分だけを取り出す
+    y = y[:, :, FH - 1::stride, FW - 1::stride][:, :, :out_h, :out_w]
+    out = buffer_pool.empty((N, out_h, out_w, FN), np.result_type(input_data, W), _role(role, 'fft_out'))
+    out[...] = y.transpose(0, 2, 3, 1)
+    return out
 
 
-def col2im(col, input_shape, filter_h, filter_w, stride=1, pad=0):
+def col2im(col, input_shape, filter_h, filter_w, stride=1, pad=0, role=None):
     """
 
     Parameters
@@ -79,6 +299,7 @@ def col2im(col, input_shape, filter_h, filter_w, stride=1, pad=0):
     filter_w
     stride
     pad
+    role : 指定すると、結果を有効なバッファプールから取り出す
 
     Returns
     -------
@@ -89,11 +310,78 @@ def col2im(col, input_shape, filter_h, filter_w, stride=1, pad=0):
     out_w = (W + 2*pad - filter_w)//stride + 1
     col = col.reshape(N, out_h, out_w, C, filter_h, filter_w).transpose(0, 3, 4, 5, 1, 2)
 
-    img = np.zeros((N, C, H + 2*pad + stride - 1, W + 2*pad + stride - 1))
+    img = buffer_pool.zeros((N, C, H + 2*pad + stride - 1, W + 2*pad + stride - 1), col.dtype,
+                            _role(role, 'img'))
     for y in range(filter_h):
         y_max = y + stride*out_h
         for x in range(filter_w):
             x_max = x + stride*out_w
             img[:, :, y:y_max:stride, x:x_max:stride] += col[:, :, y, x, :, :]
 
-    return img[:, :, pad:H + pad, pad:W + pad]
\ No newline at end of file
+    return img[:, :, pad:H + pad, pad:W + pad]
+
+
+@lru_cache(maxsize=8)
+def _col2im_indices(C, H, W, filter_h, filter_w, stride, pad):
+    """1データ分のcolの各要素が加算される、パディング済み画像(C, H_pad, W_pad)上の位置
+
+    データ数によらないため、大きさは1データ分のcolと同じ（C*filter_h*filter_w*out_h*out_w要素）
+    """
+    H_pad, W_pad = H + 2*pad, W + 2*pad
+    out_h = (H_pad - filter_h)//stride + 1
+    out_w = (W_pad - filter_w)//stride + 1
+
+    i = np.arange(out_h).reshape(out_h, 1, 1, 1, 1)
+    j = np.arange(out_w).reshape(1, out_w, 1, 1, 1)
+    c = np.arange(C).reshape(1, 1, C, 1, 1)
+    y = np.arange(filter_h).reshape(1, 1, 1, filter_h, 1)
+    x = np.arange(filter_w).reshape(1, 1, 1, 1, filter_w)
+
+    idx = ((c*H_pad + i*stride + y)*W_pad + j*stride + x).astype(np.intp).ravel()
+    idx.flags.writeable = False  # キャッシュを共有するため
+    return idx
+
+
+def col2im_vectorized(col, input_shape, filter_h, filter_w, stride=1, pad=0, role=None):
+    """Pythonのループを使わないcol2im
+
+    ストライドとフィルターサイズが等しい（パッチが重ならない）場合は並べ替えだけで済ませる。
+    それ以外は、形状ごとにキャッシュした1データ分のインデックスにデータごとのずらし幅を足し、
+    np.bincountでcolの全要素を一度に加算する。結果はcol2imと同じ
+    （np.bincountはfloat64で加算するため、float32の場合は最後に変換する）
+
+    Parameters
+    ----------
+    col :
+    input_shape : 入力データの形状（例：(10, 1, 28, 28)）
+    filter_h :
+    filter_w
+    stride
+    pad
+    role : 指定すると、結果とインデックスの配列を有効なバッファプールから取り出す
+
+    Returns
+    -------
+
+    """
+    N, C, H, W = input_shape
+    H_pad, W_pad = H + 2*pad, W + 2*pad
+    out_h = (H_pad - filter_h)//stride + 1
+    out_w = (W_pad - filter_w)//stride + 1
+
+    if stride == filter_h == filter_w:
+        col = col.reshape(N, out_h, out_w, C, filter_h, filter_w).transpose(0, 3, 1, 4, 2, 5)
+        img = buffer_pool.zeros((N, C, H_pad, W_pad), col.dtype, _role(role, 'img'))
+        img[:, :, :out_h*filter_h, :out_w*filter_w] = col.reshape(N, C, out_h*filter_h, out_w*filter_w)
+        return img[:, :, pad:H + pad, pad:W + pad]
+
+    idx = _col2im_indices(C, H, W, filter_h, filter_w, stride, pad)
+    offset = np.arange(0, N*C*H_pad*W_pad, C*H_pad*W_pad).reshape(N, 1)
+    flat_idx = buffer_pool.empty((N, idx.size), np.intp, _role(role, 'col2im_idx'))
+    np.add(offset, idx, out=flat_idx)
+    img = np.bincount(flat_idx.ravel(), weights=col.ravel(), minlength=N*C*H_pad*W_pad)
+    img = img.reshape(N, C, H_pad, W_pad)
+
+    out = buffer_pool.empty((N, C, H, W), col.dtype, _role(role, 'img'))
+    out[...] = img[:, :, pad:H + pad, pad:W + pad]
+    return out
@@ -5,8 +5,9 @@ except ImportError:
     raise ImportError('You should use Python 3.x')
 import os.path
 import gzip
-import pickle
 import os
+import struct
+import pickle
 import numpy as np
 
 
@@ -19,7 +20,8 @@ key_file = {
 }
 
 dataset_dir = os.path.dirname(os.path.abspath(__file__))
-save_file = dataset_dir + "/mnist.pkl"
+save_files = {key: dataset_dir + "/mnist_" + key + ".npy" for key in key_file}
+save_file = dataset_dir + "/mnist.pkl"  # 以前のキャッシュ（あればダウンロードせずにここから変換する）
 
 train_num = 60000
 test_num = 10000
@@ -45,12 +47,80 @@ def download_mnist():
     for v in key_file.values():
        _download(v)
 
+# IDX形式のヘッダにある型コードとNumPyの型の対応（データはビッグエンディアン）
+_idx_dtypes = {0x08: '>u1', 0x09: '>i1', 0x0B: '>i2', 0x0C: '>i4', 0x0D: '>f4', 0x0E: '>f8'}
+
+def _open_idx(file_path):
+    """gzip圧縮されていれば展開しながら、そうでなければそのまま読むファイルを開く"""
+    with open(file_path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    return gzip.open(file_path, 'rb') if is_gzip else open(file_path, 'rb')
+
+def _read_idx_header(f):
+    zero, type_code, ndim = struct.unpack('>HBB', f.read(4))
+    if zero != 0 or type_code not in _idx_dtypes:
+        raise ValueError("Not an IDX file")
+    dims = struct.unpack('>' + 'I'*ndim, f.read(4*ndim))
+
+    return np.dtype(_idx_dtypes[type_code]), dims
+
+def _readinto_full(f, arr):
+    view = memoryview(arr).cast('B')
+    filled = 0
+    while filled < len(view):
+        n = f.readinto(view[filled:])
+        if not n:
+            raise ValueError("IDX file is truncated")
+        filled += n
+
+def iter_idx(file_path, batch_size=1000):
+    """IDX形式のファイルを先頭からbatch_size件ずつ読み出すジェネレータ
+
+    gzipのストリームを展開しながら読むため、ファイル全体をメモリに載せない。
+    展開済みのファイルもそのまま読める
+
+    Parameters
+    ----------
+    file_path : IDX形式のファイル（.gzまたは展開済み）
+    batch_size : 一度に返すデータ数（最後のバッチはこれより少ないことがある）
+
+    Returns
+    -------
+    (バッチ数, ...)の配列を順に返すジェネレータ
+    """
+    with _open_idx(file_path) as f:
+        dtype, dims = _read_idx_header(f)
+        for start in range(0, dims[0], batch_size):
+            batch = np.empty((min(batch_size, dims[0] - start),) + dims[1:], dtype=dtype)
+            _readinto_full(f, batch)
+            yield batch
+
+def load_idx(file_path, batch_size=10000):
+    """IDX形式のファイルを読み込む（iter_idxで少しずつ読み、確保済みの配列に詰める）"""
+    with _open_idx(file_path) as f:
+        dtype, dims = _read_idx_header(f)
+    data = np.empty(dims, dtype=dtype.newbyteorder('='))
+
+    start = 0
+    for batch in iter_idx(file_path, batch_size):
+        data[start:start + len(batch)] = batch
+        start += len(batch)
+
+    return data
+
+def iter_mnist(key, batch_size=1000):
+    """MNISTの元ファイルをbatch_size件ずつ読み出す（keyは'train_img'など）
+
+    画像は(バッチ数, 28, 28)、ラベルは(バッチ数,)のuint8配列として返す
+    """
+    _download(key_file[key])
+    return iter_idx(dataset_dir + "/" + key_file[key], batch_size)
+
 def _load_label(file_name):
     file_path = dataset_dir + "/" + file_name
 
     print("Converting " + file_name + " to NumPy Array ...")
-    with gzip.open(file_path, 'rb') as f:
-            labels = np.frombuffer(f.read(), np.uint8, offset=8)
+    labels = load_idx(file_path)
     print("Done")
 
     return labels
@@ -59,8 +129,7 @@ def _load_img(file_name):
     file_path = dataset_dir + "/" + file_name
 
     print("Converting " + file_name + " to NumPy Array ...")
-    with gzip.open(file_path, 'rb') as f:
-            data = np.frombuffer(f.read(), np.uint8, offset=16)
+    data = load_idx(file_path)
     data = data.reshape(-1, img_size)
     print("Done")
 
@@ -76,22 +145,92 @@ def _convert_numpy():
     return dataset
 
 def init_mnist():
-    download_mnist()
-    dataset = _convert_numpy()
-    print("Creating pickle file ...")
-    with open(save_file, 'wb') as f:
-        pickle.dump(dataset, f, -1)
+    if os.path.exists(save_file):
+        print("Converting " + save_file + " ...")
+        with open(save_file, 'rb') as f:
+            dataset = pickle.load(f)
+    else:
+        download_mnist()
+        dataset = _convert_numpy()
+    print("Creating npy files ...")
+    for key, file_path in save_files.items():
+        # 複数プロセスから同時に呼ばれても書きかけのファイルを読まないようにする
+        tmp_path = file_path + ".tmp" + str(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, dataset[key])
+        os.replace(tmp_path, file_path)
     print("Done!")
 
-def _change_one_hot_label(X):
-    T = np.zeros((X.size, 10))
-    for idx, row in enumerate(T):
-        row[X[idx]] = 1
+def _change_one_hot_label(X, dtype=np.float32):
+    T = np.zeros((X.size, 10), dtype=dtype)
+    T[np.arange(X.size), X] = 1
 
     return T
 
 
-def load_mnist(normalize=True, flatten=True, one_hot_label=False):
+class LazyOneHotLabels:
+    """ラベルを整数のまま保持し、取り出したミニバッチだけをone-hot配列にする
+
+    np.argmax(t, axis=1)は元の整数ラベルをそのまま返す
+    """
+    def __init__(self, labels, dtype=np.float32):
+        self.labels = labels
+        self.shape = (labels.size, 10)
+        self.ndim = 2
+        self.size = labels.size * 10
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return self.labels.size
+
+    def __getitem__(self, index):
+        labels = self.labels[index]
+        T = _change_one_hot_label(np.atleast_1d(labels), self.dtype)
+        return T if np.ndim(labels) else T[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return _change_one_hot_label(self.labels, self.dtype if dtype is None else dtype)
+
+    def argmax(self, axis=None, out=None):
+        if axis not in (1, -1):
+            return np.asarray(self).argmax(axis=axis, out=out)
+        return np.array(self.labels, dtype=np.intp)
+
+
+def _normalize(x):
+    x = x.astype(np.float32)
+    x /= 255.0
+    return x
+
+
+class LazyNormalizedImages:
+    """uint8の画像を保持し、取り出したミニバッチだけを0.0~1.0のfloat32に正規化する
+
+    x[batch_mask]やx[:100]はその部分だけを正規化した配列を返す。
+    np.dotなどに全体を渡した場合は、その時点で全体を正規化する
+    """
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return _normalize(self.data[index])
+
+    def __array__(self, dtype=None, copy=None):
+        x = _normalize(self.data)
+        return x if dtype is None else x.astype(dtype, copy=False)
+
+    def reshape(self, *shape):
+        return LazyNormalizedImages(self.data.reshape(*shape))
+
+
+def load_mnist(normalize=True, flatten=True, one_hot_label=False, mmap_mode=None,
+               one_hot_dtype=np.float32, lazy_one_hot=False):
     """MNISTデータセットの読み込み
 
     Parameters
@@ -100,30 +239,42 @@ def load_mnist(normalize=True, flatten=True, one_hot_label=False):
     one_hot_label :
         one_hot_labelがTrueの場合、ラベルはone-hot配列として返す
         one-hot配列とは、たとえば[0,0,1,0,0,0,0,0,0,0]のような配列
+    one_hot_dtype : one-hot配列のデータ型（e.g. np.uint8）
+    lazy_one_hot : Trueの場合、one-hot配列をLazyOneHotLabelsとして返し、ミニバッチごとに作る
     flatten : 画像を一次元配列に平にするかどうか
+    mmap_mode : np.loadに渡すmmap_mode（e.g. 'r'）
+        指定した場合は画像をメモリマップで開き、プロセス間でページキャッシュを共有する。
+        normalizeがTrueなら画像はLazyNormalizedImagesとして返し、
+        正規化は取り出したミニバッチごとに行う
 
     Returns
     -------
     (訓練画像, 訓練ラベル), (テスト画像, テストラベル)
     """
-    if not os.path.exists(save_file):
+    if not all(os.path.exists(file_path) for file_path in save_files.values()):
         init_mnist()
 
-    with open(save_file, 'rb') as f:
-        dataset = pickle.load(f)
+    dataset = {}
+    for key, file_path in save_files.items():
+        dataset[key] = np.load(file_path, mmap_mode=mmap_mode)
+
+    if not flatten:
+         for key in ('train_img', 'test_img'):
+            dataset[key] = dataset[key].reshape(-1, 1, 28, 28)
 
     if normalize:
         for key in ('train_img', 'test_img'):
-            dataset[key] = dataset[key].astype(np.float32)
-            dataset[key] /= 255.0
+            if mmap_mode is None:
+                dataset[key] = _normalize(dataset[key])
+            else:
+                dataset[key] = LazyNormalizedImages(dataset[key])
 
     if one_hot_label:
-        dataset['train_label'] = _change_one_hot_label(dataset['train_label'])
-        dataset['test_label'] = _change_one_hot_label(dataset['test_label'])
-
-    if not flatten:
-         for key in ('train_img', 'test_img'):
-            dataset[key] = dataset[key].reshape(-1, 1, 28, 28)
+        for key in ('train_label', 'test_label'):
+            if lazy_one_hot:
+                dataset[key] = LazyOneHotLabels(dataset[key], one_hot_dtype)
+            else:
+                dataset[key] = _change_one_hot_label(dataset[key], one_hot_dtype)
 
     return (dataset['train_img'], dataset['train_label']), (dataset['test_img'], dataset['test_label'])
 